@@ -1,10 +1,25 @@
 #!/usr/bin/env python3
-"""Sample."""
+"""Show values or keys of a berkeley DB file (or another kv_io store).
+
+Many keys can be read at once from a file or stdin (--keys),
+--serve keeps the DB open and answers lookups over a unix socket,
+--connect sends the lookups to such a server instead of opening the DB.
+Without a query keys are listed in the key order as the cursor goes,
+optionally only those with a prefix or in a range.
+"""
 import argparse
+import os
+import signal
+import socket
+import socketserver
+import stat
 import sys
-import bsddb3
+import threading
+import kv_io
 
 __author__ = "Bogdan Kirilenko, 2018."
+WRITE_CHUNK = 10000  # keys written at once while listing
+CLIENT_BATCH = 1000  # keys sent to the server before reading the answers
 
 
 def eprint(msg, end="\n"):
@@ -21,54 +36,232 @@ def die(msg, rc=0):
 def parse_args():
     """Read args, check."""
     app = argparse.ArgumentParser()
-    app.add_argument("bdb_file")
-    app.add_argument("query") if len(sys.argv) > 2 else app.add_argument("--query")
+    app.add_argument("bdb_file", help="DB file, or server socket with --connect")
+    app.add_argument("query", nargs="?")
+    app.add_argument("--keys", "-k", help="File with keys, one per line, or stdin; "
+                     "writes key<tab>value lines")
+    app.add_argument("--serve", help="Keep the DB open and answer lookups on this unix socket")
+    app.add_argument("--connect", "-c", action="store_true", dest="connect",
+                     help="bdb_file is a socket of a running --serve process")
+    app.add_argument("--output", default="stdout", help="Output, stdout as default")
+    app.add_argument("--backend", "-b", choices=("auto",) + kv_io.BACKENDS, default="auto",
+                     help="Store type, guessed from the file by default")
+    app.add_argument("--prefix", "-p", help="List keys starting with this prefix only")
+    app.add_argument("--from", dest="key_from", help="List keys >= this key")
+    app.add_argument("--to", dest="key_to", help="List keys < this key")
+    app.add_argument("--values", "-v", action="store_true", dest="values",
+                     help="List key<tab>value lines instead of keys")
+    app.add_argument("--count", action="store_true", dest="count",
+                     help="Write the number of (listed) keys only")
     # app.add_argument("--k_num", "-k", type=int, default=0)
     # print help if there are no args
     if len(sys.argv) < 2:
         app.print_help()
         sys.exit(0)
-    args = app.parse_args()
+    args = app.parse_intermixed_args()  # query might come after the flags
     return args
 
 
-def handle_db(db_file):
+def handle_db(db_file, backend="auto"):
     """Load db."""
     try:
-        db = bsddb3.btopen(db_file, "r")
+        db = kv_io.open_db(db_file, backend)
+    except ValueError as err:  # the backend cannot be used here
+        die(str(err), rc=1)
     except Exception:
         die("Cannon open {0}".format(db_file))
     return db
 
 
+def lookup(db, key):
+    """Return value (bytes) for key (bytes) or None."""
+    return db.get(key)
+
+
 def get_value(db, query_str):
     """Load a value according the key."""
-    key = query_str.encode()
+    value = lookup(db, query_str.encode())
+    db.close()
+    if value is None:
+        die("Cannon find {0} in the file.".format(query_str))
+    return value.decode("utf-8")
+
+
+def iter_keys(keys_file):
+    """Yield keys (bytes) from a file or stdin, empty lines are skipped."""
+    f = open(keys_file, "rb") if keys_file != "stdin" else sys.stdin.buffer
+    for line in f:
+        key = line.rstrip(b"\r\n")
+        if key:
+            yield key
+    f.close() if keys_file != "stdin" else None
+
+
+def write_values(pairs, output="stdout"):
+    """Write key<tab>value lines as they come, missing keys go to stderr."""
+    f = open(output, "wb") if output != "stdout" else sys.stdout.buffer
+    for key, value in pairs:
+        if value is None:
+            eprint("Cannon find {0} in the file.".format(key.decode("utf-8")))
+            continue
+        f.write(key + b"\t" + value + b"\n")
+    f.close() if output != "stdout" else f.flush()
+
+
+class LookupHandler(socketserver.StreamRequestHandler):
+    """Answer key lines: +length<newline>value or - if there is no such key."""
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                key = line.rstrip(b"\r\n")
+                with self.server.lock:  # the DB handle is shared between threads
+                    value = lookup(self.server.db, key)
+                if value is None:
+                    self.wfile.write(b"-\n")
+                else:
+                    self.wfile.write(b"+" + str(len(value)).encode() + b"\n" + value)
+        except (BrokenPipeError, ConnectionResetError):  # the client has gone
+            pass
+
+
+class LookupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server holding the open DB, a thread per client."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, db):
+        """Bind the socket."""
+        super().__init__(socket_path, LookupHandler)
+        self.db = db
+        self.lock = threading.Lock()
+
+
+def remove_stale_socket(socket_path):
+    """Remove a socket left by a killed server; die if it is not a socket or is in use."""
+    if not os.path.lexists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        die("Error! {0} exists and is not a socket".format(socket_path), rc=1)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        value = db[key].decode("utf-8")
-        db.close()
-        return value
-    except KeyError:
+        sock.connect(socket_path)
+        die("Error! Another server is running on {0}".format(socket_path), rc=1)
+    except OSError:  # nobody listens there
+        os.remove(socket_path)
+    finally:
+        sock.close()
+
+
+def serve(db, socket_path):
+    """Answer lookups until interrupted (Ctrl+C or SIGTERM), then remove the socket."""
+    remove_stale_socket(socket_path)
+    server = LookupServer(socket_path, db)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # clean up as for Ctrl+C
+    eprint("Serving on {0}".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
         db.close()
-        die("Cannon find {0} in the file.".format(query_str))
-        return None
 
 
-def db_keys(db):
-    """Show keys."""
-    keys = [k.decode("utf-8") for k in db.keys()]
-    db.close()
-    output = "In the db keys are:\n"
-    output += ",".join(keys)
-    return output
+def query_server(socket_path, keys):
+    """Yield (key, value or None) pairs answered by a --serve process."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        die("Cannot connect to {0}".format(socket_path), rc=1)
+    answers = sock.makefile("rb")
+    keys = iter(keys)
+    while True:
+        # send keys in batches: the server must not wait for us reading the answers
+        batch = [key for _, key in zip(range(CLIENT_BATCH), keys)]
+        if not batch:
+            break
+        sock.sendall(b"".join(key + b"\n" for key in batch))
+        for key in batch:
+            status = answers.readline()
+            if status.startswith(b"+"):
+                yield key, answers.read(int(status[1:]))
+            elif status.startswith(b"-"):
+                yield key, None
+            else:
+                die("Connection to {0} is lost".format(socket_path), rc=1)
+    answers.close()
+    sock.close()
+
+
+def scan(db, prefix=None, key_from=None, key_to=None):
+    """Yield (key, value) pairs with the prefix and in [key_from, key_to), all bytes."""
+    start = max(x for x in (prefix, key_from) if x is not None) if prefix or key_from else None
+    for key, value in db.items(start):
+        if key_to is not None and key >= key_to:
+            break
+        if prefix is not None and not key.startswith(prefix):
+            break  # keys are sorted: no more keys with the prefix
+        yield key, value
+
+
+def db_keys(items, f, values=False):
+    """Write keys (or key<tab>value lines) as they come, return their number."""
+    count, chunk = 0, []
+    if not values:
+        f.write(b"In the db keys are:\n")
+    for key, value in items:
+        chunk.append(key + b"\t" + value + b"\n" if values else key)
+        count += 1
+        if len(chunk) < WRITE_CHUNK:
+            continue
+        f.write(b"".join(chunk) if values else (b"," if count > len(chunk) else b"") + b",".join(chunk))
+        chunk = []
+    if chunk:
+        f.write(b"".join(chunk) if values else (b"," if count > len(chunk) else b"") + b",".join(chunk))
+    if not values:
+        f.write(b"\n")
+    return count
 
 
 def main():
     """Entry point."""
     args = parse_args()
-    db = handle_db(args.bdb_file)
-    result = get_value(db, args.query) if args.query else db_keys(db)
-    sys.stdout.write(result + "\n")
+    if args.connect:  # a server has the DB open already
+        if args.keys:
+            write_values(query_server(args.bdb_file, iter_keys(args.keys)), args.output)
+        elif args.query:  # the same output as with the DB file
+            value = next(query_server(args.bdb_file, [args.query.encode()]))[1]
+            if value is None:
+                die("Cannon find {0} in the file.".format(args.query))
+            f = open(args.output, "w") if args.output != "stdout" else sys.stdout
+            f.write(value.decode("utf-8") + "\n")
+            f.close() if args.output != "stdout" else None
+        else:
+            die("Please provide a query or --keys with --connect", rc=1)
+        sys.exit(0)
+    db = handle_db(args.bdb_file, args.backend)
+    if args.serve:
+        serve(db, args.serve)
+    elif args.keys:
+        write_values(((key, lookup(db, key)) for key in iter_keys(args.keys)), args.output)
+        db.close()
+    elif args.query:
+        f = open(args.output, "w") if args.output != "stdout" else sys.stdout
+        f.write(get_value(db, args.query) + "\n")
+        f.close() if args.output != "stdout" else None
+    else:  # list keys
+        bounds = [x.encode() if x is not None else None for x in (args.prefix, args.key_from, args.key_to)]
+        items = scan(db, *bounds)
+        f = open(args.output, "wb") if args.output != "stdout" else sys.stdout.buffer
+        if args.count:
+            f.write("{0}\n".format(sum(1 for _ in items)).encode())
+        else:
+            db_keys(items, f, args.values)
+        f.close() if args.output != "stdout" else f.flush()
+        db.close()
     sys.exit(0)
 
 
@@ -3,10 +3,18 @@
 import argparse
 import os
 import sys
-from twobitreader import TwoBitFile
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from twobit_io import TwoBitFile
+from seq_utils import reverse_complement, translate
 
 __author__ = "Bogdan Kirilenko, 2018."
-complement = {"A": "T", "T": "A", "G": "C", "C": "G", "N": "N"}
+BATCH_SIZE = 50000  # bed lines grouped by chromosome at once
+JOB_BATCH_SIZE = 5000  # smaller batches for --jobs, to keep all processes busy
+WORKER_CACHE = None  # ChromCache of a worker process
+DECODE_FRACTION = 0.25  # decode the whole chromosome if lines in a batch span this part of it
+MODES = ("gene", "exons", "codons", "protein")
+CDS_MODES = ("codons", "protein")  # always clipped to CDS
 
 
 def eprint(msg, end="\n"):
@@ -27,11 +35,21 @@ def parse_args():
     app.add_argument("db", help="2 bit file or alias")
     app.add_argument("--utr", "-u", help="Load UTR sequences too", action="store_true", dest="utr")
     app.add_argument("--output", default="stdout", help="Output, stdout as default")
+    app.add_argument("--mode", "-m", choices=MODES, default="gene",
+                     help="gene: spliced sequence (default), exons: a record per exon, "
+                     "codons: CDS split in codons, protein: translated CDS")
+    app.add_argument("--cache_mb", type=int, default=1024,
+                     help="Memory budget for decoded chromosomes, Mb (0 - read ranges only), "
+                     "shared between --jobs")
+    app.add_argument("--jobs", "--threads", "-j", type=int, default=1, help="Number of processes")
     # print help if there are no args
     if len(sys.argv) < 2:
         app.print_help()
         sys.exit(0)
     args = app.parse_args()
+    if args.utr and args.mode in CDS_MODES:
+        eprint("Warning: --utr is ignored in {0} mode".format(args.mode))
+        args.utr = False
     return args
 
 
@@ -43,65 +61,168 @@ def get_2bit_path(db_opt):
         raise FileNotFoundError(f"{db_opt} not a regular file!")
 
 
-def revert_compl(string):
-    """Revert string; changes bases with complementary."""
-    string = string[::-1]
-    new_str = ''
-    for c in string:
-        new_c = complement.get(c)
-        new_str += new_c
-    return new_str
+class ChromCache:
+    """Decoded chromosomes within a memory budget, least recently used are dropped first.
+
+    Chromosomes which are not worth decoding are read by ranges from the 2bit file.
+    """
+
+    def __init__(self, two_bit_data, budget):
+        """Budget is the total length of cached chromosomes."""
+        self.two_bit_data = two_bit_data
+        self.budget = budget
+        self.cache = OrderedDict()
+        self.size = 0
+
+    def prepare(self, chrom, needed):
+        """Decode and cache chrom if needed bases make a big enough part of it."""
+        if chrom in self.cache:
+            self.cache.move_to_end(chrom)
+            return
+        chrom_len = len(self.two_bit_data[chrom])
+        if chrom_len > self.budget or needed < chrom_len * DECODE_FRACTION:
+            return  # ranged reads are cheaper
+        while self.size + chrom_len > self.budget:
+            _, dropped = self.cache.popitem(last=False)
+            self.size -= len(dropped)
+        self.cache[chrom] = self.two_bit_data[chrom][:]
+        self.size += chrom_len
+
+    def fetch(self, chrom, start, end):
+        """Return chrom[start: end]."""
+        chrom_seq = self.cache.get(chrom)
+        if chrom_seq is None:
+            chrom_seq = self.two_bit_data[chrom]
+        return chrom_seq[start: end]
+
+
+def get_blocks(bed_info, utr=False):
+    """Return [(start, end)] of blocks to extract, clipped to CDS unless utr."""
+    chromStart = int(bed_info[1])
+    # chromEnd = int(bed_info[2])
+    thickStart = int(bed_info[6])
+    thickEnd = int(bed_info[7])
+    # itemRgb = bed_info[8]  # never used
+    blockCount = int(bed_info[9])
+    blockSizes = [int(x) for x in bed_info[10].split(',') if x != '']
+    blockStarts = [int(x) for x in bed_info[11].split(',') if x != '']
+    # not-in-file info
+    blockEnds = [blockStarts[i] + blockSizes[i] for i in range(blockCount)]
+    blockAbsStarts = [blockStarts[i] + chromStart for i in range(blockCount)]
+    blockAbsEnds = [blockEnds[i] + chromStart for i in range(blockCount)]
+    if utr:
+        return list(zip(blockAbsStarts, blockAbsEnds))
+    blocks = []
+    # block-by-block
+    for block_num in range(blockCount):
+        blockStart = blockAbsStarts[block_num]
+        blockEnd = blockAbsEnds[block_num]
+        # skip the block if it is entirely UTR
+        if blockEnd <= thickStart:
+            continue
+        elif blockStart >= thickEnd:
+            continue
+        blockNewStart = blockStart if blockStart >= thickStart else thickStart
+        blockNewEnd = blockEnd if blockEnd <= thickEnd else thickEnd
+        blocks.append((blockNewStart, blockNewEnd))
+    return blocks
+
+
+def format_record(name, chrom, blocks, exons, strand, mode="gene"):
+    """Return fasta string for one bed line, exons are on the plus strand."""
+    gene_seq = "".join(exons)
+    if len(gene_seq) == 0:
+        return ""
+    if mode == "exons":  # numbered along the transcript
+        order = range(len(exons)) if strand else reversed(range(len(exons)))
+        return "".join(">{0}_exon_{1} {2}:{3}-{4} {5}\n{6}\n".format(
+            name, exon_num, chrom, blocks[i][0], blocks[i][1], "+" if strand else "-",
+            exons[i] if strand else reverse_complement(exons[i]))
+            for exon_num, i in enumerate(order, 1))
+    gene_seq = gene_seq if strand else reverse_complement(gene_seq)
+    if mode == "codons":
+        gene_seq = " ".join(gene_seq[i: i + 3] for i in range(0, len(gene_seq), 3))
+    elif mode == "protein":
+        gene_seq = translate(gene_seq)
+    return ">{}\n{}\n".format(name, gene_seq)
+
+
+def extract_batch(lines, chrom_cache, utr=False, mode="gene"):
+    """Return fasta strings for bed lines, in the same order.
+
+    Lines are processed chromosome by chromosome.
+    """
+    by_chrom = defaultdict(list)
+    for num, line in enumerate(lines):
+        bed_info = line.rstrip("\n").split("\t")
+        by_chrom[bed_info[0]].append((num, bed_info))
+    output = [""] * len(lines)
+    for chrom, records in by_chrom.items():
+        chrom_cache.prepare(chrom, sum(int(x[2]) - int(x[1]) for _, x in records))
+        for num, bed_info in records:
+            name = bed_info[3]  # gene_name usually
+            # bed_score = int(bed_info[4])  # never used
+            strand = True if bed_info[5] == '+' else False
+            blocks = get_blocks(bed_info, utr)
+            exons = [chrom_cache.fetch(chrom, start, end) for start, end in blocks]
+            exons = exons if utr else [exon.upper() for exon in exons]
+            output[num] = format_record(name, chrom, blocks, exons, strand, mode)
+    return output
+
+
+def iter_batches(source, batch_size=BATCH_SIZE):
+    """Yield lists of lines."""
+    batch = []
+    for line in source:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def init_worker(two_bit_path, budget):
+    """Open the 2bit file once per worker process."""
+    global WORKER_CACHE
+    WORKER_CACHE = ChromCache(TwoBitFile(two_bit_path), budget)
+
+
+def extract_task(task):
+    """Process a batch in a worker, return fasta string."""
+    lines, utr, mode = task
+    return "".join(extract_batch(lines, WORKER_CACHE, utr, mode))
+
+
+def extract_parallel(source, two_bit_path, budget, utr, mode, jobs, f):
+    """Extract batches in a process pool, write them to f in the input order."""
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(two_bit_path, budget // jobs)) as pool:
+        in_flight = deque()  # futures in the input order: reorder buffer
+        for batch in iter_batches(source, JOB_BATCH_SIZE):
+            in_flight.append(pool.submit(extract_task, (batch, utr, mode)))
+            while len(in_flight) > jobs * 2 or (in_flight and in_flight[0].done()):
+                f.write(in_flight.popleft().result())
+        while in_flight:
+            f.write(in_flight.popleft().result())
 
 
 def main():
     """Entry point."""
     args = parse_args()
     source = open(args.bed_source, "r") if args.bed_source != "stdin" else sys.stdin
-    two_bit_data = TwoBitFile(get_2bit_path(args.db))
+    two_bit_path = get_2bit_path(args.db)
+    budget = args.cache_mb * 1024 * 1024
+    f = open(args.output, "w") if args.output != "stdout" else sys.stdout
     # so let's read input
-    for num, line in enumerate(source):
-        bed_info = line[:-1].split("\t")
-        # parse bed info
-        chrom = bed_info[0]
-        chrom_seq = two_bit_data[chrom]
-        gene_seq = ""
-        chromStart = int(bed_info[1])
-        # chromEnd = int(bed_info[2])
-        name = bed_info[3]  # gene_name usually
-        # bed_score = int(bed_info[4])  # never used
-        # strand = bed_info[5]  # otherwise:
-        strand = True if bed_info[5] == '+' else False
-        thickStart = int(bed_info[6])
-        thickEnd = int(bed_info[7])
-        # itemRgb = bed_info[8]  # never used
-        blockCount = int(bed_info[9])
-        blockSizes = [int(x) for x in bed_info[10].split(',') if x != '']
-        blockStarts = [int(x) for x in bed_info[11].split(',') if x != '']
-        # not-in-file info
-        blockEnds = [blockStarts[i] + blockSizes[i] for i in range(blockCount)]
-        blockAbsStarts = [blockStarts[i] + chromStart for i in range(blockCount)]
-        blockAbsEnds = [blockEnds[i] + chromStart for i in range(blockCount)]
-        # block-by-block
-        for block_num in range(blockCount):
-            if not args.utr:
-                blockStart = blockAbsStarts[block_num]
-                blockEnd = blockAbsEnds[block_num]
-                # skip the block if it is entirely UTR
-                if blockEnd <= thickStart:
-                    continue
-                elif blockStart >= thickEnd:
-                    continue
-                blockNewStart = blockStart if blockStart >= thickStart else thickStart
-                blockNewEnd = blockEnd if blockEnd <= thickEnd else thickEnd
-                exon_seq = chrom_seq[blockNewStart: blockNewEnd].upper()
-            else:
-                exon_seq = chrom_seq[blockAbsStarts[block_num]: blockAbsEnds[block_num]]
-            gene_seq += exon_seq
-        if len(gene_seq) == 0:
-            continue
-        gene_seq = gene_seq if strand else revert_compl(gene_seq)
-        sys.stdout.write(">{}\n{}\n".format(name, gene_seq))
+    if args.jobs > 1:
+        extract_parallel(source, two_bit_path, budget, args.utr, args.mode, args.jobs, f)
+    else:
+        chrom_cache = ChromCache(TwoBitFile(two_bit_path), budget)
+        for batch in iter_batches(source):
+            f.write("".join(extract_batch(batch, chrom_cache, args.utr, args.mode)))
     source.close() if args.bed_source != "stdin" else None
+    f.close() if args.output != "stdout" else None
     sys.exit(0)
 
 
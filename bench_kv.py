@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Compare kv_io backends on a store: point lookups and scans.
+
+The store is copied into each available backend in a temporary directory,
+then the same random keys are looked up in each copy.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import kv_io
+from convert_db import convert
+
+STORE_NAMES = {"bdb": "db.bdb", "lmdb": "db.lmdb", "sqlite": "db.sqlite", "dbm": "db.dbm"}
+
+
+def parse_args():
+    """Read args, check."""
+    app = argparse.ArgumentParser()
+    app.add_argument("db", help="Store with our data, any backend")
+    app.add_argument("--backends", default=",".join(kv_io.available_backends()),
+                     help="Comma-separated backends to compare, all available by default")
+    app.add_argument("--lookups", "-n", type=int, default=10000, help="Number of random lookups")
+    app.add_argument("--prefix_len", type=int, default=3, help="Key prefix length for prefix scans")
+    app.add_argument("--tmp", default=None, help="Directory for the copies, system tmp by default")
+    app.add_argument("--seed", type=int, default=1)
+    args = app.parse_args()
+    return args
+
+
+def percentile(values, fraction):
+    """Return the value at fraction of sorted values."""
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def bench_store(path, backend, keys, prefixes):
+    """Return (open time, lookup latencies, full scan time, pairs, prefix scans time)."""
+    t0 = time.perf_counter()
+    db = kv_io.open_db(path, backend)
+    open_time = time.perf_counter() - t0
+    latencies = []
+    for key in keys:
+        t0 = time.perf_counter()
+        db.get(key)
+        latencies.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    pairs = sum(1 for _ in db.items())
+    scan_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for prefix in prefixes:
+        for key, _ in db.items(prefix):
+            if not key.startswith(prefix):
+                break
+    prefix_time = time.perf_counter() - t0
+    db.close()
+    return open_time, sorted(latencies), scan_time, pairs, prefix_time
+
+
+def main():
+    """Entry point."""
+    args = parse_args()
+    random.seed(args.seed)
+    src = kv_io.open_db(args.db)
+    all_keys = [key for key, _ in src.items()]
+    src.close()
+    if not all_keys:
+        sys.exit("{0} is empty".format(args.db))
+    keys = [random.choice(all_keys) for _ in range(args.lookups)]
+    prefixes = sorted(set(key[:args.prefix_len] for key in random.sample(all_keys, min(100, len(all_keys)))))
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp)
+    sys.stdout.write("backend\tconvert_s\topen_ms\tlookup_us_mean\tlookup_us_p50\tlookup_us_p99\t"
+                     "lookups_per_s\tscan_pairs_per_s\tprefix_scans_per_s\tsize_mb\n")
+    try:
+        for backend in args.backends.split(","):
+            try:
+                kv_io.check_backend(backend)
+            except ValueError as err:
+                sys.stderr.write("Skip {0}: {1}\n".format(backend, err))
+                continue
+            path = os.path.join(tmp_dir, STORE_NAMES[backend])
+            t0 = time.perf_counter()
+            convert(args.db, path, backend)
+            convert_time = time.perf_counter() - t0
+            open_time, latencies, scan_time, pairs, prefix_time = bench_store(path, backend, keys, prefixes)
+            size = sum(os.path.getsize(os.path.join(tmp_dir, x)) for x in os.listdir(tmp_dir)
+                       if x.startswith(STORE_NAMES[backend]))
+            mean = sum(latencies) / len(latencies)
+            sys.stdout.write("{0}\t{1:.2f}\t{2:.2f}\t{3:.2f}\t{4:.2f}\t{5:.2f}\t{6:.0f}\t{7:.0f}\t{8:.0f}\t{9:.1f}\n".format(
+                backend, convert_time, open_time * 1e3, mean * 1e6, percentile(latencies, 0.5) * 1e6,
+                percentile(latencies, 0.99) * 1e6, 1 / mean, pairs / scan_time, len(prefixes) / prefix_time,
+                size / 1024 / 1024))
+    finally:
+        shutil.rmtree(tmp_dir)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
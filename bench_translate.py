@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Measure fasta_tools translation throughput on a random codon alignment."""
+import argparse
+import random
+import sys
+import time
+from fasta_tools import translate, nta
+
+
+def parse_args():
+    """Read args, check."""
+    app = argparse.ArgumentParser()
+    app.add_argument("--seqs", type=int, default=100, help="Number of sequences")
+    app.add_argument("--codons", type=int, default=10000, help="Codons per sequence")
+    app.add_argument("--gaps", type=float, default=0.05, help="Fraction of --- and NNN codons")
+    app.add_argument("--repeats", "-r", type=int, default=3, help="Take the best of N runs")
+    app.add_argument("--seed", type=int, default=1)
+    args = app.parse_args()
+    return args
+
+
+def random_alignment(seqs_num, codons_num, gaps, seed):
+    """Make a codon alignment of random codons."""
+    random.seed(seed)
+    codons = [x for x in nta.keys() if x not in ("---", "NNN")]
+    data = {}
+    for i in range(seqs_num):
+        seq = [random.choice(("---", "NNN")) if random.random() < gaps else random.choice(codons)
+               for _ in range(codons_num)]
+        data["seq_{0}".format(i)] = "".join(seq)
+    return data
+
+
+def main():
+    """Entry point."""
+    args = parse_args()
+    data = random_alignment(args.seqs, args.codons, args.gaps, args.seed)
+    total_codons = args.seqs * args.codons
+    timings = []
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        translate(data, force=False)
+        timings.append(time.perf_counter() - t0)
+    best = min(timings)
+    sys.stdout.write("{0} sequences x {1} codons: best {2:.4f} s of {3}; {4:.0f} codons/s\n".format(
+        args.seqs, args.codons, best, args.repeats, total_codons / best))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
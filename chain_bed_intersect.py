@@ -3,30 +3,41 @@
 
 Writes to stdout the following table:
 chain_id<tab>comma-separated list of ovrelapped genes.
+Or, with --pairs: chain_id<tab>gene<tab>overlap length<tab>gene strand in the other genome.
+Chains are intersected on the target (reference) side by default,
+--query intersects bed of the query genome with chain query coordinates.
 """
+import argparse
 import sys
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import chain_io
 
 __author__ = "Bogdan Kirilenko, 2018."
+TASKS_PER_JOB = 4  # with --jobs split the work in more tasks than jobs to balance them
 
 
-def parse_chain(chain):
-    """Return chrom: ranges from chain file."""
-    # I need the headers only
+def chain_range(header, query=False):
+    """Return chrom, start, end of the chain; query coordinates are on the forward strand."""
+    if not query:
+        return header.t_name, header.t_start, header.t_end
+    elif header.q_strand == "+":
+        return header.q_name, header.q_start, header.q_end
+    return header.q_name, header.q_size - header.q_end, header.q_size - header.q_start
+
+
+def parse_chain(chain, use_index=False, query=False, blocks=False):
+    """Return chrom: ranges from chain file and chain_id: blocks (if requested)."""
+    if blocks:  # need to read everything
+        headers, chain_blocks = chain_io.read_blocks(chain, query)
+    else:  # I need the headers only
+        headers, chain_blocks = chain_io.read_headers(chain, use_index), None
     chrom_range = defaultdict(list)
-    cmd = "cat {0} | grep chain".format(chain)
-    headers = subprocess.check_output(cmd, shell=True).decode("utf-8")
-    for header in headers.split("\n"):
-        if len(header) == 0:
-            continue
-        header_info = header.split()
-        chrom = header_info[2]
-        start = int(header_info[5])
-        end = int(header_info[6])
-        chain_id = header_info[12]
-        chrom_range[chrom].append((chain_id, start, end))
-    return chrom_range
+    for header in headers:
+        chrom, start, end = chain_range(header, query)
+        chrom_range[chrom].append((header.chain_id, start, end, header.q_strand))
+    return chrom_range, chain_blocks
 
 
 def parse_bed(bed):
@@ -34,12 +45,13 @@ def parse_bed(bed):
     chrom_range = defaultdict(list)
     f = open(bed, "r")
     for line in f:
-        line_info = line.split("\t")
+        line_info = line.rstrip("\n").split("\t")
         chrom = line_info[0]
         start = int(line_info[1])
         end = int(line_info[2])
         gene = line_info[3]
-        chrom_range[chrom].append((gene, start, end))
+        strand = line_info[5] if len(line_info) > 5 else "."
+        chrom_range[chrom].append((gene, start, end, strand))
     f.close()
     return chrom_range
 
@@ -49,110 +61,197 @@ def intersect(range_1, range_2):
     return min(range_1[2], range_2[2]) - max(range_1[1], range_2[1])
 
 
-def find_first(chains, beds):
-    """Find indexes for the first intersection."""
-    if intersect(chains[0], beds[0]) > 0:  # no need to search
-        return 0, 0
-    first_bed_start, first_bed_end = beds[0][1], beds[0][2]
-    first_chain_start, first_chain_end = chains[0][1], chains[0][2]
-    if first_chain_end < first_bed_start:
-        # we have lots of chains in the beginning not intersecting beds
-        for i in range(len(chains)):
-            if intersect(chains[i], beds[0]) > 0:
-                return i, 0
-            elif chains[i][1] > beds[0][2]:
-                return i, 1
-    else:  # lots of beds in the beginning not covered by chains
-        for i in range(len(beds)):
-            if intersect(chains[i], beds[0]) > 0:
-                return 0, i
-            elif beds[i][1] > chains[0][2]:
-                return 1, i
-
-
-def overlap(chains, beds):
-    """Return intersections for chain: bed."""
-    # init state, find FIRST bed intersecting the FIRST chain
+class IntervalIndex:
+    """Implicit augmented interval tree over intervals sorted by start (as in cgranges).
+
+    Intervals are kept in flat lists; index i is a tree node of level = number
+    of trailing 1-bits in i, max_ends[i] is the maximal end in its subtree.
+    """
+
+    def __init__(self, ranges):
+        """Build the index for (name, start, end, strand) ranges."""
+        ranges = sorted(ranges, key=lambda x: x[1])
+        self.names = [x[0] for x in ranges]
+        self.starts = [x[1] for x in ranges]
+        self.ends = [x[2] for x in ranges]
+        self.strands = [x[3] for x in ranges]
+        self.max_ends = list(self.ends)
+        self.max_level = self._augment()
+
+    def _augment(self):
+        """Fill max_ends bottom-up, return the tree height."""
+        n, max_ends = len(self.ends), self.max_ends
+        if n == 0:
+            return -1
+        last_i = (n - 1) & ~1  # the last leaf
+        last = max_ends[last_i]  # max end of the rightmost node at the current level
+        k = 1
+        while 1 << k <= n:
+            x = 1 << (k - 1)
+            for i in range((x << 1) - 1, n, x << 2):
+                right = max_ends[i + x] if i + x < n else last
+                max_ends[i] = max(max_ends[i], max_ends[i - x], right)
+            last_i = last_i - x if last_i >> k & 1 else last_i + x  # parent of the last node
+            if last_i < n and max_ends[last_i] > last:
+                last = max_ends[last_i]
+            k += 1
+        return k - 1
+
+    def query(self, start, end):
+        """Return indexes of intervals overlapping [start, end), sorted by start."""
+        n, starts, ends, max_ends = len(self.starts), self.starts, self.ends, self.max_ends
+        hits = []
+        if n == 0:
+            return hits
+        stack = [(self.max_level, (1 << self.max_level) - 1, False)]  # level, node, left child done
+        while stack:
+            k, x, left_done = stack.pop()
+            if k <= 3:  # small subtree: just scan it
+                i0 = x >> k << k
+                i1 = min(i0 + (1 << (k + 1)) - 1, n)
+                for i in range(i0, i1):
+                    if starts[i] >= end:
+                        break
+                    if start < ends[i]:
+                        hits.append(i)
+            elif not left_done:
+                y = x - (1 << (k - 1))  # the left child, might be out of range
+                stack.append((k, x, True))
+                if y >= n or max_ends[y] > start:
+                    stack.append((k - 1, y, False))
+            elif x < n and starts[x] < end:  # the node itself and the right child
+                if start < ends[x]:
+                    hits.append(x)
+                stack.append((k - 1, x + (1 << (k - 1)), False))
+        return sorted(hits)
+
+
+def blocks_overlap(blocks, start, end):
+    """Return overlap of [start, end) with the chain blocks (starts and ends arrays)."""
+    starts, ends = blocks
+    length = 0
+    for i in range(bisect_right(ends, start), bisect_left(starts, end)):
+        length += min(ends[i], end) - max(starts[i], start)
+    return length
+
+
+def mapped_strand(strand, q_strand):
+    """Return the gene strand in the other genome: flipped by a - chain (target strand is always +)."""
+    if q_strand == "-" and strand in ("+", "-"):
+        return "-" if strand == "+" else "+"
+    return strand
+
+
+def overlap(chains, beds, blocks=None):
+    """Return intersections for chain: [(bed, overlap length, bed strand in the other genome)].
+
+    With blocks only the aligned blocks of chains are considered, not the whole span.
+    """
     chain_beds = defaultdict(list)
-    chain_init, start_with = find_first(chains, beds)
-    chains_num = len(chains)
-    bed_len = len(beds)
-    for i in range(chain_init, chains_num):
-        FLAG = False  # was intersection or not?
-        FIRST = True
-        chain = chains[i]
-        while True:
-            if FIRST:  # start with previous start, first iteration
-                bed_num = start_with
-                FIRST = False  # guarantee that this condition works ONCE per loop
-            else:  # just increase the pointer
-                bed_num += 1  # to avoid inf loop
-
-            if bed_num >= bed_len:
-                break  # beds are over
-            # pick the bed range
-            bed = beds[bed_num]
-
-            if chain[2] < bed[1]:  # too late
-                break  # means that bed is "righter" than chain
-
-            if intersect(chain, bed) > 0:
-                if not FLAG:  # the FIRST intersection of this chain
-                    start_with = bed_num  # guarantee that I will assign to starts with
-                    # only the FIRST intersection (if it took place)
-                    FLAG = True  # otherwise starts with will be preserved
-                # save the intersection
-                chain_beds[chain[0]].append(bed[0])
-
-            else:  # we recorded all the region with intersections
-                if chain[1] > bed[2]:  # too early
-                    # in case like:
-                    # gene A EEEEE----------------------------------------EEEEEE #
-                    # gene B               EEEEEEEEEE                            #
-                    # gene C                               EEEEEEEEE             #
-                    # chain                                    ccccc             #
-                    # at gene A I will get FLAG = True and NO intersection with gene B
-                    # --> I will miss gene C in this case without this condition.
+    bed_index = IntervalIndex(beds)
+    for chain in sorted(chains, key=lambda x: x[1]):
+        chain_id, chain_start, chain_end, chain_strand = chain
+        for i in bed_index.query(chain_start, chain_end):
+            bed = (bed_index.names[i], bed_index.starts[i], bed_index.ends[i])
+            if blocks is not None:  # gene might be in a chain gap
+                length = blocks_overlap(blocks[chain_id], bed[1], bed[2])
+                if length == 0:
                     continue
+            else:
+                length = intersect(chain, bed)
+            chain_beds[chain_id].append((bed[0], length, mapped_strand(bed_index.strands[i], chain_strand)))
+    return chain_beds
 
-                elif FLAG:  # this is not a nested gene
-                    break  # and all intersections are saved --> proceed to the next chain
 
-    return chain_beds
+def overlap_task(task):
+    """Run overlap for a (chains, beds, blocks) task, return a list of chain: beds pairs."""
+    return list(overlap(*task).items())
+
+
+def make_tasks(chain_data, bed_data, jobs, blocks=None):
+    """Split chromosomes in (chains, beds, blocks) tasks with similar numbers of chains.
+
+    Chains of big chromosomes are split in parts, sorted by start,
+    so concatenated results of the tasks are in the same order as in a serial run.
+    """
+    chroms = list(bed_data.keys())
+    total = sum(len(chain_data[chrom]) for chrom in chroms)
+    max_chains = max(1, total // (jobs * TASKS_PER_JOB))
+    tasks = []
+    for chrom in chroms:
+        chains = sorted(chain_data[chrom], key=lambda x: x[1])
+        for part_start in range(0, len(chains), max_chains):
+            part = chains[part_start: part_start + max_chains]
+            # each task gets the blocks of its own chains only
+            part_blocks = {x[0]: blocks[x[0]] for x in part} if blocks is not None else None
+            tasks.append((part, bed_data[chrom], part_blocks))
+    return tasks
+
+
+def iter_overlaps(chain_data, bed_data, jobs=1, blocks=None):
+    """Yield chain: [(bed, overlap length)] pairs chromosome by chromosome."""
+    if jobs <= 1:  # just the main loop
+        for chrom in bed_data.keys():
+            for item in overlap(chain_data[chrom], bed_data[chrom], blocks).items():
+                yield item
+        return
+    tasks = make_tasks(chain_data, bed_data, jobs, blocks)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # start with the biggest tasks, but give the results out in the tasks order
+        by_size = sorted(range(len(tasks)), key=lambda i: len(tasks[i][0]) + len(tasks[i][1]), reverse=True)
+        futures = {num: pool.submit(overlap_task, tasks[num]) for num in by_size}
+        for num in range(len(tasks)):
+            for item in futures.pop(num).result():
+                yield item
 
 
-def chain_bed_intersect(chain, bed):
+def chain_bed_intersect(chain, bed, use_index=False, jobs=1, query=False, blocks=False):
     """Entry point."""
     # get list of chrom: ranges for both
-    chain_data = parse_chain(chain)
+    chain_data, chain_blocks = parse_chain(chain, use_index, query, blocks)
     bed_data = parse_bed(bed)
-    chroms = list(bed_data.keys())
-    chain_bed_dict = {}  # out answer
-    # main loop
-    for chrom in chroms:
-        # sort the ranges
-        bed_ranges = sorted(bed_data[chrom], key=lambda x: x[1])
-        chain_ranges = sorted(chain_data[chrom], key=lambda x: x[1])
-        chrom_chain_beds = overlap(chain_ranges, bed_ranges)
-        chain_bed_dict.update(chrom_chain_beds)
-    return chain_bed_dict
+    return iter_overlaps(chain_data, bed_data, jobs, chain_blocks)
 
 
-def save(dct, output="stdout"):
-    """Save output in the file given."""
+def save(chain_beds, output="stdout", pairs=False):
+    """Save chain: beds pairs in the file given, as they come."""
     f = open(output, "w") if output != "stdout" else sys.stdout
-    for k, v in dct.items():
-        f.write("{0}\t{1}\n".format(k, ",".join(v) + ","))
-    f.close()
+    for k, v in chain_beds:
+        if pairs:
+            f.write("".join("{0}\t{1}\t{2}\t{3}\n".format(k, *x) for x in v))
+        else:
+            f.write("{0}\t{1}\n".format(k, ",".join(x[0] for x in v) + ","))
+    f.close() if output != "stdout" else None
 
 
-if __name__ == "__main__":
-    try:  # read args
-        chain_file = sys.argv[1]
-        bed_file = sys.argv[2]
-    except IndexError:
-        sys.stderr.write("Usage: {} [chain_file] [bed file]\n".format(sys.argv[0]))
+def parse_args():
+    """Read args, check."""
+    app = argparse.ArgumentParser()
+    app.add_argument("chain_file", help="Chain file, might be gzipped")
+    app.add_argument("bed_file", help="Bed file")
+    app.add_argument("--pairs", action="store_true", dest="pairs",
+                     help="Write chain_id, gene, overlap length and the gene strand in the other "
+                     "genome (flipped by a - chain, . for genes without strand) for each pair")
+    app.add_argument("--output", default="stdout", help="Output, stdout as default")
+    app.add_argument("--header_index", action="store_true", dest="header_index",
+                     help="Save chain headers next to the chain file ({0}) "
+                     "and read them from there next time".format(chain_io.HEADER_INDEX_SUFFIX))
+    app.add_argument("--jobs", "-j", type=int, default=1, help="Number of processes")
+    app.add_argument("--query", "-q", action="store_true", dest="query",
+                     help="Bed is for the query genome: intersect with chain query coordinates")
+    app.add_argument("--blocks", "-b", action="store_true", dest="blocks",
+                     help="Use aligned blocks of chains, genes in chain gaps are not reported")
+    # print help if there are no args
+    if len(sys.argv) < 3:
+        app.print_help()
         sys.stderr.write("Output goes to stdout.\n")
         sys.exit(0)
-    chain_bed_dict = chain_bed_intersect(chain_file, bed_file)
-    save(chain_bed_dict)
+    args = app.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    chain_beds = chain_bed_intersect(args.chain_file, args.bed_file, args.header_index, args.jobs,
+                                     args.query, args.blocks)
+    save(chain_beds, args.output, args.pairs)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Chain file reading: headers only, or headers with the aligned blocks.
+
+Plain and gzipped chain files are supported.
+Header index (one line per chain: offset and the header fields)
+can be saved next to the chain file and reused while it is up to date:
+its first line keeps the chain file size and mtime, any change of them
+makes the index rebuilt (a file copied with cp -p or rsync keeps an old mtime).
+"""
+import gzip
+import os
+from array import array
+from collections import namedtuple
+
+CHUNK_SIZE = 1 << 24  # read 16Mb at once
+HEADER_INDEX_SUFFIX = ".hidx"
+STAT_FIELD = "#chain_stat"
+ChainHeader = namedtuple("ChainHeader", ["chain_id", "score", "t_name", "t_size", "t_strand",
+                                         "t_start", "t_end", "q_name", "q_size", "q_strand",
+                                         "q_start", "q_end", "offset"])
+
+
+def open_chain(chain_file):
+    """Open chain file in binary mode, gzipped or not."""
+    return gzip.open(chain_file, "rb") if chain_file.endswith(".gz") else open(chain_file, "rb")
+
+
+def parse_header(line, offset):
+    """Make ChainHeader from a chain header line."""
+    # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+    fields = line.decode("utf-8").split()
+    return ChainHeader(fields[12], int(fields[1]), fields[2], int(fields[3]), fields[4],
+                       int(fields[5]), int(fields[6]), fields[7], int(fields[8]), fields[9],
+                       int(fields[10]), int(fields[11]), offset)
+
+
+def scan_headers(chain_file):
+    """Yield (offset, header line) for each chain.
+
+    Raw buffers are searched for newline + chain, so block lines are never split.
+    Offsets are in the uncompressed stream for gzipped files.
+    """
+    pattern = b"\nchain"
+    f = open_chain(chain_file)
+    buf, offset = b"\n", -1  # pretend there is a newline before the file start
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        eof = len(chunk) == 0
+        buf += chunk
+        i, keep_from = 0, None
+        while True:
+            j = buf.find(pattern, i)
+            if j == -1:
+                break
+            k = buf.find(b"\n", j + 1)
+            if k == -1 and not eof:  # the header is not complete yet
+                keep_from = j
+                break
+            k = len(buf) if k == -1 else k
+            yield offset + j + 1, buf[j + 1: k]
+            i = k  # the newline is a part of the next pattern
+        if eof:
+            break
+        # keep the tail: it might contain a part of the next pattern
+        keep_from = max(i, len(buf) - len(pattern)) if keep_from is None else keep_from
+        offset += keep_from
+        buf = buf[keep_from:]
+    f.close()
+
+
+def chain_stat(chain_file):
+    """Return size and mtime (ns) of the chain file."""
+    st = os.stat(chain_file)
+    return st.st_size, st.st_mtime_ns
+
+
+def save_header_index(headers, index_file, stat):
+    """Write the chain file stat and header index: one tab-separated line per chain."""
+    with open(index_file, "w") as f:
+        f.write("{0}\t{1}\t{2}\n".format(STAT_FIELD, *stat))
+        for header in headers:
+            f.write("\t".join(str(x) for x in header) + "\n")
+
+
+def load_header_index(index_file):
+    """Read header index, return chain file stat and a list of ChainHeader.
+
+    Stat is None if the file is not an index of ours.
+    """
+    headers = []
+    int_fields = (1, 3, 5, 6, 8, 10, 11, 12)
+    with open(index_file, "r") as f:
+        stat_line = f.readline().rstrip("\n").split("\t")
+        if len(stat_line) != 3 or stat_line[0] != STAT_FIELD:
+            return None, headers
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            headers.append(ChainHeader(*[int(x) if n in int_fields else x for n, x in enumerate(fields)]))
+    return (int(stat_line[1]), int(stat_line[2])), headers
+
+
+def read_headers(chain_file, use_index=False):
+    """Return a list of ChainHeader.
+
+    With use_index load the saved header index if the chain file size and mtime
+    are the same as saved there, otherwise scan the file and save the index.
+    """
+    index_file = chain_file + HEADER_INDEX_SUFFIX
+    stat = chain_stat(chain_file)
+    if use_index and os.path.isfile(index_file):
+        saved_stat, headers = load_header_index(index_file)
+        if saved_stat == stat:
+            return headers
+    headers = [parse_header(line, offset) for offset, line in scan_headers(chain_file)]
+    if use_index:
+        try:  # reuse it next time, if we can
+            save_header_index(headers, index_file, stat)
+        except OSError:
+            pass
+    return headers
+
+
+def read_blocks(chain_file, query=False):
+    """Read the whole chain file, return a list of ChainHeader and chain_id: (starts, ends).
+
+    Starts and ends of the aligned blocks are kept in two arrays per chain,
+    in target or (with query) in query coordinates, on the forward strand
+    and sorted by start in both cases.
+    """
+    headers, blocks = [], {}
+    header, starts, ends, pos, offset = None, None, None, 0, 0
+
+    def flush():
+        if header is None:
+            return
+        if query and header.q_strand == "-":  # minus strand: pos -> q_size - pos
+            blocks[header.chain_id] = (array("q", [header.q_size - x for x in reversed(ends)]),
+                                       array("q", [header.q_size - x for x in reversed(starts)]))
+        else:
+            blocks[header.chain_id] = (starts, ends)
+
+    f = open_chain(chain_file)
+    for line in f:
+        if line.startswith(b"chain"):
+            flush()
+            header = parse_header(line, offset)
+            headers.append(header)
+            pos = header.q_start if query else header.t_start
+            starts, ends = array("q"), array("q")
+        else:
+            fields = line.split()
+            if len(fields) == 0 or header is None:  # the empty line after each chain or comments
+                offset += len(line)
+                continue
+            size = int(fields[0])
+            starts.append(pos)
+            ends.append(pos + size)
+            if len(fields) == 3:  # size dt dq, the last line contains size only
+                pos += size + int(fields[2 if query else 1])
+        offset += len(line)
+    flush()
+    f.close()
+    return headers, blocks
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""Run codon_ali_quality_check over many alignments: a directory or a list of files.
+
+Alignments are checked in a process pool, results are written by this
+process only, in the input order, with the gene (file name without the
+fasta suffix) in the first column. Each finished gene is recorded in a
+checkpoint file together with the output size at that moment, so
+--resume cuts a partly written gene and goes on from there.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import fasta_io
+import codon_ali_quality_check as caqc
+
+__author__ = "Bogdan Kirilenko, 2018"
+CHECKPOINT_SUFFIX = ".done"
+HEADER = "gene\tsp\tpositions\tseq\tshift\tscore\tzero\n"
+FASTA_SUFFIXES = (".fa", ".fasta", ".fas", ".fna")
+TASK_CHUNK = 16  # alignments sent to a worker at once
+
+
+def eprint(msg):
+    """Write to stderr."""
+    sys.stderr.write(msg + "\n")
+
+
+def die(msg, rc=1):
+    """Interrupt program."""
+    eprint(msg)
+    sys.exit(rc)
+
+
+def parse_args():
+    """Read args, check (if possible)."""
+    app = argparse.ArgumentParser("Codon alignment quality check of many alignments.")
+    app.add_argument("input", type=str, help="Directory with codon alignments, or a file with their paths.")
+    app.add_argument("species", type=str, help="Species of interest, comma-separated list, "
+                     "or all. Alignments without a species are skipped for it.")
+    app.add_argument("output", type=str, help="Save result in...")
+    app.add_argument("--window_size", "-w", type=int, default=7, help="Window size, must be > 2.")
+    app.add_argument("--threshold", type=float, default=2.0, help="Score considered as significant.")
+    app.add_argument("--jobs", "-j", type=int, default=1, help="Number of processes.")
+    app.add_argument("--resume", "-r", action="store_true", dest="resume",
+                     help="Skip genes listed in the checkpoint ({0}) and append to the output.".format(
+                         CHECKPOINT_SUFFIX))
+    if len(sys.argv) < 4:  # there are no arguments
+        app.print_help()
+        sys.exit(0)
+    args = app.parse_args()
+    caqc.check_params(args.window_size, args.threshold)
+    return args
+
+
+def gene_id(path):
+    """Return the file name without the fasta suffix."""
+    name = os.path.basename(path)
+    for suffix in FASTA_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def list_alignments(input_path):
+    """Return a list of (gene, path), directory files in the name order."""
+    if os.path.isdir(input_path):
+        paths = [os.path.join(input_path, x) for x in sorted(os.listdir(input_path)) if x.endswith(FASTA_SUFFIXES)]
+    else:
+        with open(input_path, "r") as f:
+            paths = [x.strip() for x in f if x.strip()]
+    alignments = [(gene_id(x), x) for x in paths]
+    genes = [x[0] for x in alignments]
+    if len(set(genes)) != len(genes):
+        die("Error! Gene names (file names) must be unique.")
+    return alignments
+
+
+def read_checkpoint(checkpoint):
+    """Return complete checkpoint lines and output size after the last of them."""
+    lines, size = [], 0
+    if not os.path.isfile(checkpoint):
+        return lines, size
+    with open(checkpoint, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if not line.endswith("\n") or len(fields) != 3:  # killed while writing this line
+                break
+            lines.append(line)
+            size = int(fields[2])
+    return lines, size
+
+
+def check_alignment(task):
+    """Return (gene, result lines, error message) for one alignment."""
+    gene, path, species, window_size, threshold = task
+    try:
+        sequences, order = fasta_io.read_fasta(path)
+        sp_list = [x for x in order if x in species] if species != "all" else order
+        if not sp_list:  # nothing to check here
+            return gene, "", None
+        seq_len = len(sequences[sp_list[0]])
+        base_counts = caqc.count_bases(sequences, seq_len)
+        caqc.check_window_size(sequences[sp_list[0]], window_size)
+        lines = "".join(caqc.check_species(sp, sequences, base_counts, window_size, threshold) for sp in sp_list)
+    except (ValueError, OSError) as err:  # broken alignment or unreadable file
+        return gene, "", str(err)
+    return gene, "".join(gene + "\t" + line + "\n" for line in lines.splitlines()), None
+
+
+def iter_results(tasks, jobs):
+    """Yield check_alignment results in the tasks order."""
+    if jobs <= 1:
+        for task in tasks:
+            yield check_alignment(task)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(check_alignment, tasks, chunksize=TASK_CHUNK):
+            yield result
+
+
+def main():
+    """Entry point."""
+    args = parse_args()
+    alignments = list_alignments(args.input)
+    species = args.species if args.species == "all" else set(args.species.split(","))
+    checkpoint = args.output + CHECKPOINT_SUFFIX
+    done_lines, size = read_checkpoint(checkpoint) if args.resume else ([], 0)
+    done = set(x.split("\t")[0] for x in done_lines)
+    if args.resume and os.path.isfile(args.output):
+        f = open(args.output, "r+")
+        f.truncate(size)  # drop lines of a gene which was not finished
+        f.seek(size)
+    else:
+        f = open(args.output, "w")
+    if f.tell() == 0:
+        f.write(HEADER)
+    done_f = open(checkpoint, "w")  # without a broken last line, if any
+    done_f.write("".join(done_lines))
+    tasks = [(gene, path, species, args.window_size, args.threshold)
+             for gene, path in alignments if gene not in done]
+    eprint("{0} alignments to check, {1} done before".format(len(tasks), len(alignments) - len(tasks)))
+    failed = 0
+    for gene, lines, error in iter_results(tasks, args.jobs):
+        if error is not None:
+            eprint("Error in {0}: {1}".format(gene, error))
+            failed += 1
+        f.write(lines)
+        f.flush()  # results of the gene are in the file before it goes to the checkpoint
+        done_f.write("{0}\t{1}\t{2}\n".format(gene, "failed" if error else "ok", f.tell()))
+        done_f.flush()
+    f.close()
+    done_f.close()
+    eprint("Done, {0} alignments failed".format(failed)) if failed else None
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,19 @@
 """Check codon alignment quality."""
 import argparse
 import sys
-from collections import Counter, defaultdict
-import operator
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fasta_io
 
 __author__ = "Bogdan Kirilenko, 2018"
 # defaults
 LETTERS = ["A", "T", "G", "C", "N", "-"]
 STATES = [-2, -1, 0, 1, 2]
+MISSING_SCORE = -0.25  # score of a base absent in the column, or out of the alignment
+WORKER_DATA = None  # (sequences, base_counts, window_size, threshold) of a worker process
+# lut: byte -> counts column (LETTERS first, then other letters met), counts: L x alphabet
+BaseCounts = namedtuple("BaseCounts", ["lut", "counts", "sequences_num"])
 
 
 def eprint(msg):
@@ -28,144 +34,152 @@ def parse_args():
     # read arguments
     app = argparse.ArgumentParser("A tool for codon alignment quality estimation.")
     app.add_argument("input", type=str, help="Input fasta file containg aligned sequences.")
-    app.add_argument("species", type=str, help="Species of interest, like 'mm10'. Single or comma-separated list.")
+    app.add_argument("species", type=str, help="Species of interest, like 'mm10'. Single or comma-separated list, "
+                     "or all to check each sequence against the rest.")
     app.add_argument("output", type=str, help="Save result in...")
     app.add_argument("--window_size", "-w", type=int, default=7, help="Window size, 7"
                      " is recommended (default), must be > 2.")
     app.add_argument("--threshold", type=float, default=2.0, help="Score considered as significant.")
     app.add_argument("-a", "--append", action="store_true", dest="append",
                      help="Use to append the results in a file that already exists.")
+    app.add_argument("--jobs", "-j", type=int, default=1, help="Check species in N processes.")
     args = app.parse_args()
     # check if everything is alright
     if len(sys.argv) < 3:  # there are no arguments
         app.print_help()
         sys.exit(0)
-    if args.window_size < 3:  # it makes no sence to use window of this size
-        die("Error! Expected window size  > 2, {} given.".format(args.window_size))
-    if args.window_size <= args.threshold:
-        die("Error! Requested threshold {0} is unreachable! "
-            "It should be less than window size {1}".format(args.threshold, args.window_size))
-    elif args.threshold < 0:
-        die("Error! Threshold should be > 0, {0} given.".format(args.threshold))
+    check_params(args.window_size, args.threshold)
     return args
 
 
+def check_params(window_size, threshold):
+    """Die if window size or threshold make no sence."""
+    if window_size < 3:  # it makes no sence to use window of this size
+        die("Error! Expected window size  > 2, {} given.".format(window_size))
+    if window_size <= threshold:
+        die("Error! Requested threshold {0} is unreachable! "
+            "It should be less than window size {1}".format(threshold, window_size))
+    elif threshold < 0:
+        die("Error! Threshold should be > 0, {0} given.".format(threshold))
+
+
 def read_fasta(fasta_file):
     """Read fasta, return sequences."""
-    # open the file
-    with open(fasta_file, "r") as f:
-        fasta_data = f.read().split(">")
-
-    assert fasta_data[0] == ""  # if assertion is failed - it is not a fasta
-    sequences = {}  # save results here
-    order = []  # in case if we are interested in the order
-
-    # read line by line
-    for elem in fasta_data[1:]:  # the first elem is ""
-        raw_lines = elem.split("\n")  # might be useful if there is fasta-80 or fasta-60
-        header = raw_lines[0]  # >header\nATGAGAGAGTTAC --> header, ATGACACATACGA
-        lines = [x for x in raw_lines[1:] if x != ""]  # the last elem is "" and the first is the header
-        sequence = "".join(lines)
-        # add data to collectors
-        sequences[header] = sequence
-        order.append(header)
-
-    # check if data is correct
-    if len(sequences) == 0:  # either empty or the file is corrupted
-        die("Error, there are no fasta-formatted sequences in {}!".format(fasta_file))
-
-    if len(sequences.keys()) != len(order):  # means there are non-unique headers
-        err_msg = "Error! Sequence names must be unique! There are " \
-                  "{0} sequences with {1} unique names!".format(len(sequences.keys()), len(order))
-        die(err_msg)
-
-    return sequences, order
-
-
-def compute_frequences(sequences, seq_len):
-    """Return dict position: frequences for bases."""
-    frequences = {}
-    sequences_num = len(sequences.keys())
-    columns = defaultdict(list)  # revert sp: sequence to number - bases
+    try:
+        return fasta_io.read_fasta(fasta_file)
+    except ValueError as err:  # not a fasta, empty or non-unique names
+        die(str(err))
+
+
+def encode(seq):
+    """Return the sequence as a uint8 array, a byte per letter."""
+    return np.frombuffer(seq.encode("latin-1", "replace"), dtype=np.uint8)
+
 
+def count_bases(sequences, seq_len):
+    """Return BaseCounts: how many times each letter is met in each column."""
+    alphabet = set()
     for k, seq in sequences.items():
         if len(seq) != seq_len:      # check that sequences are equal in length
             err_msg = "Error! Sequences must have the equal lenght! Make sure that you " \
                       "operate with aligned sequences! {0} has {1} bases but your sp has {2}".format(k, len(seq), seq_len)
-            die(err_msg)
-
-        # they are equal --> let's work
-        for num, base in enumerate(seq):  # num of base and base
-            columns[num].append(base)  # num: [base base base]
-
-    # convert to frequences
-    for num, column in columns.items():
-        quantities = Counter(column)  # count frequences of As, Ts etc
-        frequences[num] = {k: v / sequences_num for k, v in quantities.items()}  # absolute numbers to relatives
-    # consider special cases
-    for cond in [-2, -1, seq_len, seq_len + 1]:
-        frequences[cond] = {}  # in case we will call frequences [-2]
-    return frequences
-
-
-def split_windows(sp_seq, window_size):
-    """Split a sequence in a set of subsequences according the window size."""
+            raise ValueError(err_msg)
+        alphabet.update(seq)
+    letters = LETTERS + sorted(alphabet.difference(LETTERS))  # soft-masked or odd letters get own columns
+    lut = np.zeros(256, dtype=np.intp)
+    lut[encode("".join(letters))] = np.arange(len(letters))
+    dtype = np.uint16 if len(sequences) < 1 << 16 else np.uint32
+    counts = np.zeros((seq_len, len(letters)), dtype=dtype)
+    positions = np.arange(seq_len)
+    for seq in sequences.values():  # a letter per column: no repeated indexes
+        counts[positions, lut[encode(seq)]] += 1
+    return BaseCounts(lut, counts, len(sequences))
+
+
+def check_window_size(sp_seq, window_size):
+    """Raise ValueError if the sequence is shorter than the window."""
     if window_size > len(sp_seq):  # in case if sequence is too short (window is too huge) it makes no sence
-        die("Error! Window size {0} is bigger than sequence len {1}!".format(window_size, len(sp_seq)))
-    return [sp_seq[i:i+window_size] for i in range(len(sp_seq) - window_size + 1)]
-
-
-def get_scores(frequences, windows):
-    """Return score for each shift for each window."""
-    window_scores = {}
-    # main loop
-    for w_num, window in enumerate(windows):  # num of the first base
-        # define start point in absolute coordinates
-        window_scores[w_num] = {}  # collect shift: score for each
-        # test each possible shift between -2 -1 0 1 2
-        for shift in STATES:
-            shift_score = 0  # each shift has the own score
-            # check score of each position
-            for b_num, base in enumerate(window):
-                freq_pos = w_num + b_num + shift  # start of the window + number of base in window + shift
-                freq_data = frequences[freq_pos]  # get corresponding dict
-                base_score = freq_data.get(base) if freq_data.get(base) else -0.25  # in case of None
-                shift_score += base_score  # add base score to shift score
-            window_scores[w_num][shift] = shift_score
-            window_scores[w_num]["seq"] = window  # save sequence just in case
+        raise ValueError("Error! Window size {0} is bigger than sequence len {1}!".format(window_size, len(sp_seq)))
+
+
+def get_scores(base_counts, sp_seq, window_size):
+    """Return windows x STATES array of scores.
+
+    Frequences are computed over all sequences but sp_seq: its own base is
+    subtracted from the counts. Window sums are accumulated base by base, in
+    the same order as one window at a time would do it, so float results are
+    exactly the same.
+    """
+    seq_len = len(sp_seq)
+    seq_codes = base_counts.lut[encode(sp_seq)]
+    positions = np.arange(seq_len)
+    sequences_num = max(base_counts.sequences_num - 1, 1)
+    windows_num = seq_len - window_size + 1
+    window_scores = np.zeros((windows_num, len(STATES)))
+    for s_num, shift in enumerate(STATES):
+        columns = positions + shift
+        inside = (columns >= 0) & (columns < seq_len)  # columns -2, -1, L, L + 1 have no bases
+        columns = np.clip(columns, 0, seq_len - 1)
+        # how many other sequences have the same base in the shifted column
+        others = base_counts.counts[columns, seq_codes].astype(np.int64) - (seq_codes[columns] == seq_codes)
+        base_scores = np.where(inside & (others > 0), others / sequences_num, MISSING_SCORE)
+        for b_num in range(window_size):  # add b_num-th base of each window
+            window_scores[:, s_num] += base_scores[b_num: b_num + windows_num]
     return window_scores
 
 
-def check_scores(window_scores, threshold):
+def check_scores(window_scores, threshold, sp_seq, window_size):
     """Return positions: shift in case if shift is not the best."""
+    zero_num = STATES.index(0)
+    best = np.argmax(window_scores, axis=1)  # the first one of equal scores, as max() does
+    best_scores = window_scores[np.arange(len(best)), best]
+    zero_scores = window_scores[:, zero_num]
+    # if shift != zero --> alignment is broken here
+    # and the score is better then defined threshold and much bigger than zero shift score
+    broken = (best != zero_num) & (best_scores > threshold) & (best_scores > zero_scores * 1.5)
     suspect = {}
-    for w_num, scores in window_scores.items():
-        # get sequence and remove it
-        sequence = scores["seq"]
-        del scores["seq"]
-        # get the maximal score
-        shift, score = max(scores.items(), key=operator.itemgetter(1))
-        # if shift != zero --> alignment is broken here
-        # and also there are some conditions to check
-        zero_condition = shift != 0  # it should be not shift 0
-        thr_condirion = score > threshold  # better then defined threshold
-        sign_condition = score > scores[0] * 1.5  # and bigger than 0
-        # are all these conditions true?
-        all_conditions = zero_condition and thr_condirion and sign_condition
-        if all_conditions:  # and if yes append this stuff
-            suspect[w_num] = (shift, score, sequence, scores[0])
+    for w_num in np.flatnonzero(broken).tolist():
+        suspect[w_num] = (STATES[best[w_num]], float(best_scores[w_num]),
+                          sp_seq[w_num: w_num + window_size], float(zero_scores[w_num]))
     return suspect
 
 
-def save_result(broken_places, window_size, output, append, sp):
-    """Save the result."""
-    output_line = "sp\tpositions\tseq\tshift\tscore\tzero\n"  # collect result there
+def check_species(sp, sequences, base_counts, window_size, threshold):
+    """Return result lines for one species checked against the rest."""
+    sp_seq = sequences[sp]
+    # compute all the possible scores
+    window_scores = get_scores(base_counts, sp_seq, window_size)
+    # filter scores if zero-shift is not the best one
+    broken_places = check_scores(window_scores, threshold, sp_seq, window_size)
+    return format_result(broken_places, window_size, sp)
+
+
+def init_worker(*data):
+    """Keep the alignment and counts in the worker process."""
+    global WORKER_DATA
+    WORKER_DATA = data
+
+
+def check_species_task(sp):
+    """Run check_species in a worker."""
+    return check_species(sp, *WORKER_DATA)
+
+
+def format_result(broken_places, window_size, sp):
+    """Return output lines for the suspect windows."""
+    output_line = ""  # collect result there
     for start_point, shift_score_seq_zer in broken_places.items():
         shift, score, seq, zero = shift_score_seq_zer  # it is a tuple (shift, score, sequence, zero)
         end_point = start_point + window_size  # user-friendly output
         position = "{0}-{1}".format(start_point + 1, end_point)
         new_line = "{0}\t{1}\t{2}\t{3}\t{4:.4f}\t{5:.4f}\n".format(sp, position, seq, shift, score, zero)
         output_line += new_line  # append this line
+    return output_line
+
+
+def save_result(results, output, append):
+    """Save the result."""
+    output_line = "sp\tpositions\tseq\tshift\tscore\tzero\n" + "".join(results)
     # define the mode of file object according -a param
     m = "a" if append else "w"  # a - append to existing file, w - create a new file
     if m == "a" and output == "stdout":  # if stdout there isn't file to append
@@ -181,21 +195,27 @@ def main():
     """Entry point."""
     args = parse_args()  # load args
     sequences, order = read_fasta(args.input)  # read fasta
-    if args.species not in order:  # check if we can use these species
-        err_msg = "Error! There is no sequence with name {0} " \
-                  "The possible options are:\n{1}".format(args.species, " ".join(sorted(order)))
-        die(err_msg)
-    sp_seq = sequences[args.species]  # pick the sequence of interest
-    del sequences[args.species]  # don't need it there
-    # the main part of program
-    frequences = compute_frequences(sequences, len(sp_seq))  # compute frequences for each column
-    windows = split_windows(sp_seq, args.window_size)  # get all the sequences with the certain window size
-    # compute all the possible scores
-    window_scores = get_scores(frequences, windows)
-    # filter scores if zero-shift is not the best one
-    broken_places = check_scores(window_scores, args.threshold)
+    species = order if args.species == "all" else args.species.split(",")
+    for sp in species:
+        if sp not in sequences:  # check if we can use these species
+            err_msg = "Error! There is no sequence with name {0} " \
+                      "The possible options are:\n{1}".format(sp, " ".join(sorted(order)))
+            die(err_msg)
+    seq_len = len(sequences[species[0]])
+    # the main part of program: count bases in each column once, each species is left out later
+    try:
+        base_counts = count_bases(sequences, seq_len)
+        check_window_size(sequences[species[0]], args.window_size)
+    except ValueError as err:  # not an alignment or too short
+        die(str(err))
+    data = (sequences, base_counts, args.window_size, args.threshold)
+    if args.jobs > 1 and len(species) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=data) as pool:
+            results = list(pool.map(check_species_task, species))
+    else:
+        results = [check_species(sp, *data) for sp in species]
     # save it wherever we need it
-    save_result(broken_places, args.window_size, args.output, args.append, args.species)
+    save_result(results, args.output, args.append)
     sys.exit(0)  # say good bye
 
 
@@ -1,31 +1,21 @@
 #!/sw/bin/python3
-"""Difference between two sequences."""
+"""Difference between two sequences.
+
+Or, with --matrix / --vs_ref, between all pairs of sequences in a codon alignment.
+"""
 import argparse
 import sys
-from evolve import get_alts
+import numpy as np
+import fasta_io
+from evolve import MASKED, get_alts
+from seq_utils import GENETIC_CODE
 
 __author__ = "Bogdan Kirilenko, 2018."
 
 # genetic code
-AA_CODE = {"TTT": "F", "TTC": "F", "TTA": "L", "TTG": "L",
-           "TCT": "S", "TCC": "S", "TCA": "S", "TCG": "S",
-           "TAT": "Y", "TAC": "Y", "TAA": "*", "TAG": "*",
-           "TGT": "C", "TGC": "C", "TGA": "*", "TGG": "W",
-           "CTT": "L", "CTC": "L", "CTA": "L", "CTG": "L",
-           "CCT": "P", "CCC": "P", "CCA": "P", "CCG": "P",
-           "CAT": "H", "CAC": "H", "CAA": "Q", "CAG": "Q",
-           "CGT": "R", "CGC": "R", "CGA": "R", "CGG": "R",
-           "ATT": "I", "ATC": "I", "ATA": "I", "ATG": "M",
-           "ACT": "T", "ACC": "T", "ACA": "T", "ACG": "T",
-           "AAT": "N", "AAC": "N", "AAA": "K", "AAG": "K",
-           "AGT": "S", "AGC": "S", "AGA": "R", "AGG": "R",
-           "GTT": "V", "GTC": "V", "GTA": "V", "GTG": "V",
-           "GCT": "A", "GCC": "A", "GCA": "A", "GCG": "A",
-           "GAT": "D", "GAC": "D", "GAA": "E", "GAG": "E",
-           "GGT": "G", "GGC": "G", "GGA": "G", "GGG": "G",
-           "---": "-", "NNN": "X"}
-# combinations to take care of
-MASKED = ["NNN", "---", "TAG", "TGA", "TAA"]
+AA_CODE = GENETIC_CODE
+NO_DATA = 9999  # ratio with zero denominator
+PAIRS_HEADER = "seq_1\tseq_2\tdiff_codons\tchanges\tsyn\tnon_syn\tsyn_sites\tnon_syn_sites\tratio\tomega\n"
 
 
 def eprint(msg, end="\n"):
@@ -42,47 +32,37 @@ def die(msg, rc=0):
 def parse_args():
     """Read args, check."""
     app = argparse.ArgumentParser()
-    app.add_argument("first_fasta", type=str, help="First fasta file.")
-    app.add_argument("first_sp", type=str, help="Species from the first file.")
-    app.add_argument("second_fasta", type=str, help="First fasta file. Write - if the same with the first.")
-    app.add_argument("second_sp", type=str, help="Species from the first file. "
+    app.add_argument("first_fasta", type=str, nargs="?", help="First fasta file.")
+    app.add_argument("first_sp", type=str, nargs="?", help="Species from the first file.")
+    app.add_argument("second_fasta", type=str, nargs="?", help="First fasta file. Write - if the same with the first.")
+    app.add_argument("second_sp", type=str, nargs="?", help="Species from the first file. "
                      "Write - to use the same species with the first.")
     app.add_argument("--no_mask", action="store_true", dest="no_mask",
                      help="Do not ignore NNN's and ---'s.")
+    app.add_argument("--matrix", help="Batch mode: omega matrix for all pairs in a codon alignment, "
+                     "row is the first sequence")
+    app.add_argument("--vs_ref", nargs=2, metavar=("FASTA", "REF"),
+                     help="Batch mode: compare REF with each sequence in FASTA, writes a table")
+    app.add_argument("--table", action="store_true", dest="table",
+                     help="With --matrix write a table of all pairs instead of the matrix")
+    app.add_argument("--output", default="stdout", help="Batch mode output, stdout as default")
     # print help if there are no args
     if len(sys.argv) < 2:
         app.print_help()
         sys.exit(0)
     args = app.parse_args()
+    if not args.matrix and not args.vs_ref and not args.second_sp:
+        app.print_help()
+        sys.exit(0)
     return args
 
 
-def read_fasta(fasta_file):
-    """Read fasta, return dict and type."""
-    # open the file
-    with open(fasta_file, "r") as f:
-        fasta_data = f.read().split(">")
-    assert fasta_data[0] == ""  # if a file starts with > it should be empty
-    del fasta_data[0]  # remove it "" we don't need that
-    sequences = {}  # accumulate data here
-    order = []  # to have ordered list
-    # read line by line
-    for elem in fasta_data:
-        raw_lines = elem.split("\n")
-        header = raw_lines[0]  # it must be first ['capHir1', 'ATGCCGCGCCAATTCCCCAAGCTGA... ]
-        lines = [x for x in raw_lines[1:] if x != ""]  # separate nucleotide-containing lines
-        if len(lines) == 0:  # it is a mistake - empty sequene --> get rid of
-            continue
-        fasta_content = "".join(lines)
-        sequences[header] = fasta_content
-        order.append(header)
-    if len(sequences) == 0:
-        die("There are not fasta-formatted sequences in {0}!".format(fasta_file))
-    if len(sequences.keys()) != len(order):  # it is possible in case of non-unique headers
-        err = "Error! Sequences names must be unique! There are" \
-              " {0} sequences and {1} unique names!".format(len(sequences.keys()), len(order))
-        die(err)
-    return sequences, order
+def get_sequences(fasta_file, names):
+    """Fetch the sequences requested using the fasta index."""
+    try:
+        return fasta_io.fetch_seqs(fasta_file, names)
+    except ValueError as err:  # not a fasta, empty or non-unique names
+        die(str(err))
 
 
 def parts(lst, n=25):
@@ -95,18 +75,118 @@ def codons_dist(codon1, codon2):
     return sum([1 for i in range(3) if codon1[i] != codon2[i]])
 
 
+def encode_codons(sequences):
+    """Return codon strings and N x codons array of their numbers."""
+    seq_len = len(sequences[0])
+    if any(len(seq) != seq_len for seq in sequences):
+        die("Error! Sequences of the same length are required!")
+    if seq_len % 3 != 0 or seq_len == 0:
+        die("Error! Codon alignment required!")
+    data = np.array([np.frombuffer(seq.encode("latin-1", "replace"), dtype="S3") for seq in sequences])
+    uniq, codes = np.unique(data, return_inverse=True)
+    return [x.decode("latin-1") for x in uniq], codes.reshape(data.shape)
+
+
+def pair_table(codons, no_mask=False):
+    """Return codons x codons table: codons_dist << 2 | non-syn << 1 | syn.
+
+    The bits are set for the codon pairs counted as a difference.
+    """
+    table = np.zeros((len(codons), len(codons)), dtype=np.int8)
+    for i, first_codon in enumerate(codons):
+        for j, second_codon in enumerate(codons):
+            if first_codon == second_codon:
+                continue
+            if not no_mask and (first_codon in MASKED or second_codon in MASKED):
+                continue
+            syn = AA_CODE.get(first_codon) == AA_CODE.get(second_codon)
+            table[i, j] = codons_dist(first_codon, second_codon) << 2 | (1 if syn else 2)
+    return table
+
+
+def pair_stats(syns, non_syns, syn_codons, nsyn_codons):
+    """Return ratio of sites and omega, as the single pair mode does."""
+    omega_base = nsyn_codons / syn_codons if syn_codons != 0 else NO_DATA
+    non_syn_to_syn = non_syns / syns if syns != 0 else NO_DATA
+    omega = non_syn_to_syn / omega_base if syns != 0 else NO_DATA
+    return omega_base, omega
+
+
+def compare_all(names, sequences, first_nums, no_mask=False):
+    """Yield (first, second, diff codons, changes, syn, non-syn, syn sites, non-syn sites, ratio, omega).
+
+    Each first sequence is compared with all sequences at once: codons are numbers,
+    so a pair of codons is an index in the precomputed pair table.
+    """
+    codons, codes = encode_codons(sequences)
+    table = pair_table(codons, no_mask).ravel()
+    syn_sites = np.array([len(get_alts(x)[0]) for x in codons])
+    nsyn_sites = np.array([len(get_alts(x)[1]) for x in codons])
+    for i in first_nums:
+        pairs = table[codes[i] * len(codons) + codes]  # sequences x codons
+        syns = np.count_nonzero(pairs & 1, axis=1)
+        non_syns = np.count_nonzero(pairs & 2, axis=1)
+        changes = (pairs >> 2).sum(axis=1, dtype=np.int64)
+        # sites depend on the first sequence only
+        syn_codons, nsyn_codons = int(syn_sites[codes[i]].sum()), int(nsyn_sites[codes[i]].sum())
+        for j in range(len(names)):
+            omega_base, omega = pair_stats(int(syns[j]), int(non_syns[j]), syn_codons, nsyn_codons)
+            yield (names[i], names[j], int(syns[j] + non_syns[j]), int(changes[j]), int(syns[j]),
+                   int(non_syns[j]), syn_codons, nsyn_codons, omega_base, omega)
+
+
+def write_matrix(names, results, f):
+    """Write omega matrix: first sequences are rows."""
+    f.write("\t" + "\t".join(names) + "\n")
+    row, row_name = [], None
+    for result in results:
+        if result[0] != row_name and row:
+            f.write(row_name + "\t" + "\t".join(row) + "\n")
+            row = []
+        row_name = result[0]
+        row.append(str(result[-1]))
+    f.write(row_name + "\t" + "\t".join(row) + "\n") if row else None
+
+
+def compare_batch(args):
+    """Batch modes: --matrix or --vs_ref."""
+    fasta_file = args.matrix if args.matrix else args.vs_ref[0]
+    try:
+        data, names = fasta_io.read_fasta(fasta_file)
+    except ValueError as err:  # not a fasta, empty or non-unique names
+        die(str(err))
+    if args.vs_ref and args.vs_ref[1] not in data:
+        die("Error! There is no {0} in the {1}".format(args.vs_ref[1], fasta_file))
+    first_nums = range(len(names)) if args.matrix else [names.index(args.vs_ref[1])]
+    results = compare_all(names, [data[x] for x in names], first_nums, args.no_mask)
+    f = open(args.output, "w") if args.output != "stdout" else sys.stdout
+    if args.matrix and not args.table:
+        write_matrix(names, results, f)
+    else:
+        f.write(PAIRS_HEADER)
+        for result in results:
+            if args.vs_ref and result[1] == args.vs_ref[1]:
+                continue  # ref vs ref
+            f.write("\t".join(str(x) for x in result) + "\n")
+    f.close() if args.output != "stdout" else None
+
+
 def main():
     """Entry point."""
     args = parse_args()
-    # read fastas, the first one
-    first_seqs, first_species = read_fasta(args.first_fasta)
-    if args.first_sp not in first_species:
-        die("Error! There is no {0} in the {1}".format(args.first_sp, args.first_fasta))
-    # and the second one
+    if args.matrix or args.vs_ref:
+        compare_batch(args)
+        sys.exit(0)
     second_fasta = args.second_fasta if args.second_fasta != "-" else args.first_fasta
     second_sp = args.second_sp if args.second_sp != "-" else args.first_sp
-    second_seqs, second_species = read_fasta(second_fasta)
-    if second_sp not in second_species:
+    # fetch the sequences, the first one
+    same_file = second_fasta == args.first_fasta
+    first_seqs = get_sequences(args.first_fasta, [args.first_sp, second_sp] if same_file else [args.first_sp])
+    if args.first_sp not in first_seqs:
+        die("Error! There is no {0} in the {1}".format(args.first_sp, args.first_fasta))
+    # and the second one
+    second_seqs = get_sequences(second_fasta, [second_sp]) if not same_file else first_seqs
+    if second_sp not in second_seqs:
         die("Error! There is no {0} in the {1}".format(args.second_sp, second_fasta))
     # get sequences
     first_seq = first_seqs[args.first_sp]
@@ -157,9 +237,7 @@ def main():
                                             first_codon, second_codon,
                                             f_AA, s_AA, synline))
         diff_number += 1  # number of differencies
-    omega_base = nsyn_codons / syn_codons if syn_codons != 0 else 9999
-    non_syn_to_syn = non_syns / syns if syns != 0 else 9999
-    omega = non_syn_to_syn / omega_base if syns != 0 else 9999
+    omega_base, omega = pair_stats(syns, non_syns, syn_codons, nsyn_codons)
     sys.stdout.write("Overall {0} different codons and {1} changes; {2} synonymous and {3} non-synonymous;\n" \
                      "There are {4} synonymous and {5} non-synonymous sites, ratio is {6}\n" \
                      "Omega: {7}\n".format(diff_number - 1, changes, syns, non_syns, syn_codons,
@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
-"""Compare two protein sequences."""
+"""Compare two protein sequences.
+
+Or many pairs at once: from a table (--pairs) or all vs reference (--vs_ref).
+"""
 import argparse
 import os
 import sys
 from collections import defaultdict
+import numpy as np
+import fasta_io
 
 __author__ = "Bogdan Kirilenko, 2018."
 EPSTEINS_MATRIX_PATH = os.path.join(os.path.dirname(__file__), "data", "Epsteins_difference.txt")
@@ -11,6 +16,8 @@ BLOSUM62_MATRIX_PATH = os.path.join(os.path.dirname(__file__), "data", "BLOSUM62
 GAP_SCORE = 0  # score for -
 MASK_SCORE = 0  # score for X
 STOP_SCORE = 0  # score for *
+BATCH_ROWS = 512  # sequences compared with the same reference in one call
+BATCH_HEADER = "seq_1\tseq_2\tidentity\tepstein_similarity\tblosum62\tidentical_aa\tlength\teffective_length\n"
 
 
 def eprint(msg, end="\n"):
@@ -24,51 +31,36 @@ def die(msg, rc=0):
     sys.exit(rc)
 
 
-def read_fasta(fasta_stream):
-    """Read fasta, return dict and type."""
-    # open the file
-    f = open(fasta_stream, "r") if fasta_stream != "stdin" else sys.stdin
-    fasta_data = f.read().split(">")
-    f.close()
-    # assert fasta_data[0] == ""  # if a file starts with > it should be empty
-    del fasta_data[0]  # remove it "" we don't need that
-    sequences = {}  # accumulate data here
-    order = []  # to have ordered list
-    # read line by line
-
-    for elem in fasta_data:
-        raw_lines = elem.split("\n")
-        header = raw_lines[0]  # it must be first ['capHir1', 'ATGCCGCGCCAATTCCCCAAGCTGA... ]
-
-        lines = [x for x in raw_lines[1:] if x != ""]  # separate nucleotide-containing lines
-        if len(lines) == 0:  # it is a mistake - empty sequene --> get rid of
-            continue
-
-        fasta_content = "".join(lines)
-        sequences[header] = fasta_content
-        order.append(header)
-    if len(sequences) == 0:
-        die("There are not fasta-formatted sequences in {0}!".format(fasta_stream))
-    if len(sequences.keys()) != len(order):  # it is possible in case of non-unique headers
-        err = "Error! Sequences names must be unique! There are" \
-              " {0} sequences and {1} unique names!".format(len(sequences.keys()), len(order))
-        die(err)
-    return sequences
+def get_sequences(fasta_file, names):
+    """Fetch the sequences requested using the fasta index."""
+    try:
+        return fasta_io.fetch_seqs(fasta_file, names)
+    except ValueError as err:  # not a fasta, empty or non-unique names
+        die(str(err))
 
 
 def parse_args():
     """Read args, check."""
     app = argparse.ArgumentParser()
-    app.add_argument("fasta_1", help="Fasta file containing the first sequence")
-    app.add_argument("seq_1", help="Sequence 1 identifyer")
-    app.add_argument("fasta_2", help="Fasta file containing the second sequence. "
+    app.add_argument("fasta_1", nargs="?", help="Fasta file containing the first sequence")
+    app.add_argument("seq_1", nargs="?", help="Sequence 1 identifyer")
+    app.add_argument("fasta_2", nargs="?", help="Fasta file containing the second sequence. "
                      "Write - if the first file is same")
-    app.add_argument("seq_2", help="Second sequence identifyer, - if the same with seq_1")
+    app.add_argument("seq_2", nargs="?", help="Second sequence identifyer, - if the same with seq_1")
+    app.add_argument("--pairs", help="Batch mode: table of pairs, either seq_1<tab>seq_2 "
+                     "(sequences from --fasta) or fasta_1<tab>seq_1<tab>fasta_2<tab>seq_2")
+    app.add_argument("--fasta", help="Fasta file for two-column --pairs table")
+    app.add_argument("--vs_ref", nargs=2, metavar=("FASTA", "REF"),
+                     help="Batch mode: compare each sequence in FASTA with REF")
+    app.add_argument("--output", default="stdout", help="Batch mode output table, stdout as default")
     # print help if there are no args
     if len(sys.argv) < 2:
         app.print_help()
         sys.exit(0)
     args = app.parse_args()
+    if not args.pairs and not args.vs_ref and not args.seq_2:
+        app.print_help()
+        sys.exit(0)
     return args
 
 
@@ -120,12 +112,80 @@ def make_blosum_matrix(matrix_path=BLOSUM62_MATRIX_PATH):
     return MATRIX
 
 
-def main():
-    """Entry point."""
-    args = parse_args()
+def to_dense(matrix):
+    """Convert dict-of-dicts matrix to 256 x 256 array indexed by letter codes.
+
+    Pairs not in the matrix are nan.
+    """
+    dense = np.full((256, 256), np.nan)
+    for row_char, row in matrix.items():
+        for col_char, score in row.items():
+            dense[ord(row_char), ord(col_char)] = score
+    return dense
+
+
+def load_matrices():
+    """Read both matrices once, return dense Epsteins and BLOSUM62 arrays."""
+    return to_dense(make_epsteins_matrix()), to_dense(make_blosum_matrix())
+
+
+def encode(seqs):
+    """Return (sequences x length) uint8 array of letter codes."""
+    return np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8).reshape(len(seqs), -1)
+
+
+def score_vs_ref(ref_seq, seqs, epsteins_matrix, blosum62_matrix):
+    """Compare ref_seq with each of the aligned seqs at once.
+
+    Return arrays (one value per sequence): identical AA, Epsteins sums,
+    BLOSUM62 sums, effective lengths and whether all the letters could be scored.
+    """
+    if any(len(seq) != len(ref_seq) for seq in seqs):
+        raise ValueError("Aligned sequences required")
+    ref = encode([ref_seq])[0]
+    que = encode(seqs)
+    same = que == ref
+    ref_gap, que_gap = ref == ord("-"), que == ord("-")
+    ref_mask, que_mask = ref == ord("X"), que == ord("X")
+    ref_stop, que_stop = ref == ord("*"), que == ord("*")
+    # both masked, both gaps or both stops: ignored columns
+    skipped = same & (ref_gap | ref_mask | ref_stop)
+    identical = same & ~skipped
+    gap = ref_gap | que_gap
+    ep_scores = np.select([skipped, identical, gap, ref_mask | que_mask, ref_stop | que_stop],
+                          [0, 1, GAP_SCORE, MASK_SCORE, STOP_SCORE], default=epsteins_matrix[ref, que])
+    bl_scores = np.select([skipped, gap], [0, GAP_SCORE], default=blosum62_matrix[ref, que])
+    scorable = ~(np.isnan(ep_scores).any(axis=1) | np.isnan(bl_scores).any(axis=1))
+    # cumsum adds up from left to right, so float sums are exactly as in a plain loop
+    eps_sum = np.cumsum(ep_scores, axis=1)[:, -1] if len(ref_seq) else np.zeros(len(seqs))
+    blosum_sum = np.nan_to_num(bl_scores).sum(axis=1).astype(int)
+    comp_seq_len = len(ref_seq) - skipped.sum(axis=1)
+    return identical.sum(axis=1), eps_sum, blosum_sum, comp_seq_len, scorable
+
+
+def compare_pair(seq_1, seq_2, epsteins_matrix, blosum62_matrix):
+    """Return identical AA, Epsteins and BLOSUM62 sums, length and effective length."""
+    identical_aa, eps_sum, blosum_sum, comp_seq_len, scorable = \
+        score_vs_ref(seq_1, [seq_2], epsteins_matrix, blosum62_matrix)
+    if not scorable[0]:
+        raise ValueError("Letters out of the matrices")
+    return int(identical_aa[0]), float(eps_sum[0]), int(blosum_sum[0]), len(seq_1), int(comp_seq_len[0])
+
+
+def percents(stats):
+    """Return Epsteins similarity and identity in percents."""
+    identical_aa, eps_sum_score, _, _, comp_seq_len = stats
+    if comp_seq_len == 0:  # nothing to compare
+        return float("nan"), float("nan")
+    return eps_sum_score / comp_seq_len * 100, identical_aa / comp_seq_len * 100
+
+
+def compare_single(args):
+    """Compare two sequences, print human-readable statistics."""
     # read data and check if it's correct
-    fasta_1_data = read_fasta(args.fasta_1)
-    fasta_2_data = read_fasta(args.fasta_2) if args.fasta_2 != "-" else fasta_1_data
+    same_file = args.fasta_2 == "-" or args.fasta_2 == args.fasta_1
+    fasta_1_data = get_sequences(args.fasta_1, [args.seq_1, args.seq_2] if same_file else [args.seq_1])
+    fasta_2_data = get_sequences(args.fasta_2, [args.seq_2]) if not same_file else fasta_1_data
     seq_1 = fasta_1_data.get(args.seq_1)
     seq_2 = fasta_2_data.get(args.seq_2)
     die("Error! Sequence {} not found in {}!".format(args.seq_1, args.fasta_1)) if not seq_1 else None
@@ -133,53 +193,119 @@ def main():
     die("Error! Aligned sequences required! (seq_1 and seq_2 have different lenghts)")\
         if len(seq_1) != len(seq_2) else None
     # so let's get started
-    epsteins_matrix = make_epsteins_matrix()
-    BLOSUM62_matxix = make_blosum_matrix()
-    identical_aa = 0
-    seq_len = comp_seq_len = len(seq_1)
-    eps_sum_score, blosum_sum_score = 0, 0
-    for ch1, ch2 in zip(seq_1, seq_2):
-        # ignored cases
-        if ch1 == ch2 == "X":
-            # both masked
-            comp_seq_len -= 1
-            continue
-        elif ch1 == ch2 == "-":
-            # both gaps
-            comp_seq_len -= 1
-            continue
-        elif ch1 == ch2 == "*":
-            # both stops
-            comp_seq_len -= 1
-            continue
-        # scores to be computed
-        elif ch1 == ch2:
-            ep_score = 1
-            bl_score = BLOSUM62_matxix[ch1][ch2]
-            identical_aa += 1
-        elif ch1 == "-" or ch2 == "-":
-            ep_score = GAP_SCORE
-            bl_score = GAP_SCORE
-        elif ch1 == "X" or ch2 == "X":
-            ep_score = MASK_SCORE
-            bl_score = BLOSUM62_matxix[ch1][ch2]
-        elif ch1 == "*" or ch2 == "*":
-            ep_score == STOP_SCORE
-            bl_score = BLOSUM62_matxix[ch1][ch2]
-        else:
-            bl_score = BLOSUM62_matxix[ch1][ch2]
-            ep_score = epsteins_matrix[ch1][ch2]
-        eps_sum_score += ep_score
-        blosum_sum_score += bl_score
+    epsteins_matrix, blosum62_matrix = load_matrices()
+    try:
+        stats = compare_pair(seq_1, seq_2, epsteins_matrix, blosum62_matrix)
+    except ValueError as err:  # letters out of the matrices
+        die("Error! {0}".format(err))
+    identical_aa, _, blosum_sum_score, seq_len, comp_seq_len = stats
+    ep_perc_sim, perc_id = percents(stats)
     # output
-    ep_perc_sim = eps_sum_score / comp_seq_len * 100
-    perc_id = identical_aa / comp_seq_len * 100
     print("Percent similarity according the Epsteins matrix: {}".format(ep_perc_sim))
     print("Percent identity: {}".format(perc_id))
     print("Alignment score according BLOSUM62: {}".format(blosum_sum_score))
     print("Identical amino acids: {}".format(identical_aa))
     print("Sequence length: {}".format(seq_len))
     print("Effective sequence length: {}".format(comp_seq_len))
+
+
+def read_pairs(pairs_file, fasta_file):
+    """Yield key, name_1, seq_1, name_2, seq_2 for each line of the pairs table.
+
+    key is (fasta_1, name_1): pairs with the same first sequence share it.
+    """
+    sources = {}  # fasta file: mapped fasta, each one is indexed once
+
+    def fetch(fasta, name):
+        if fasta not in sources:
+            sources[fasta] = fasta_io.MappedFasta(fasta)
+        return sources[fasta].fetch(name) if name in sources[fasta] else None
+
+    f = open(pairs_file, "r") if pairs_file != "stdin" else sys.stdin
+    prev_key, seq_1 = None, None
+    for line in f:
+        line_data = line.rstrip("\n").split("\t")
+        if len(line_data) == 2 and fasta_file:
+            fasta_1, name_1, fasta_2, name_2 = fasta_file, line_data[0], fasta_file, line_data[1]
+        elif len(line_data) == 4:
+            fasta_1, name_1, fasta_2, name_2 = line_data
+            fasta_2 = fasta_1 if fasta_2 == "-" else fasta_2
+        else:
+            eprint("Warning! Cannot parse pairs line {0}, skipped".format(line.rstrip()))
+            continue
+        if (fasta_1, name_1) != prev_key:  # fetch the first sequence once for consecutive lines
+            prev_key, seq_1 = (fasta_1, name_1), fetch(fasta_1, name_1)
+        yield prev_key, name_1, seq_1, name_2, fetch(fasta_2, name_2)
+    f.close() if pairs_file != "stdin" else None
+    for source in sources.values():
+        source.close()
+
+
+def read_vs_ref(fasta_file, ref_name):
+    """Yield key, ref_name, ref_seq, name, seq for each sequence in the fasta."""
+    ref_seq = get_sequences(fasta_file, [ref_name]).get(ref_name)
+    die("Error! Sequence {} not found in {}!".format(ref_name, fasta_file)) if not ref_seq else None
+    for name, seq in fasta_io.iter_fasta(fasta_file):
+        if name == ref_name:
+            continue
+        yield (fasta_file, ref_name), ref_name, ref_seq, name, seq
+
+
+def compare_batch(pairs, output):
+    """Compare each pair, write a table; matrices are loaded once.
+
+    Consecutive pairs with the same key (fasta_1, name_1) are scored in one call.
+    """
+    epsteins_matrix, blosum62_matrix = load_matrices()
+    f = open(output, "w") if output != "stdout" else sys.stdout
+    f.write(BATCH_HEADER)
+    chunk = []  # (name_2, seq_2) compared with the same name_1, seq_1
+
+    def flush(name_1, seq_1):
+        if len(chunk) == 0:
+            return
+        try:
+            scores = score_vs_ref(seq_1, [x[1] for x in chunk], epsteins_matrix, blosum62_matrix)
+        except ValueError:  # not ascii letters
+            eprint("Warning! Cannot encode sequences, {0} vs {1} skipped".format(
+                name_1, ",".join(x[0] for x in chunk)))
+            chunk.clear()
+            return
+        for num, (name_2, _) in enumerate(chunk):
+            identical_aa, eps_sum, blosum_sum, comp_seq_len, scorable = [x[num] for x in scores]
+            if not scorable:
+                eprint("Warning! Letters out of the matrices: {0} and {1} skipped".format(name_1, name_2))
+                continue
+            ep_perc_sim, perc_id = percents((identical_aa, eps_sum, blosum_sum, len(seq_1), comp_seq_len))
+            f.write("{0}\t{1}\t{2:.4f}\t{3:.4f}\t{4}\t{5}\t{6}\t{7}\n".format(
+                name_1, name_2, perc_id, ep_perc_sim, blosum_sum, identical_aa, len(seq_1), comp_seq_len))
+        chunk.clear()
+
+    prev_key, prev_name, prev_seq = None, None, None
+    for key, name_1, seq_1, name_2, seq_2 in pairs:
+        if seq_1 is None or seq_2 is None:
+            eprint("Warning! Sequence {0} not found, skipped".format(name_1 if seq_1 is None else name_2))
+            continue
+        elif len(seq_1) != len(seq_2):
+            eprint("Warning! {0} and {1} have different lengths, skipped".format(name_1, name_2))
+            continue
+        if key != prev_key or len(chunk) >= BATCH_ROWS:  # a new reference
+            flush(prev_name, prev_seq)
+            prev_key, prev_name, prev_seq = key, name_1, seq_1
+        chunk.append((name_2, seq_2))
+    flush(prev_name, prev_seq)
+    f.close() if output != "stdout" else None
+
+
+def main():
+    """Entry point."""
+    args = parse_args()
+    if args.pairs:
+        compare_batch(read_pairs(args.pairs, args.fasta), args.output)
+    elif args.vs_ref:
+        compare_batch(read_vs_ref(*args.vs_ref), args.output)
+    else:
+        compare_single(args)
     sys.exit(0)
 
 
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Copy a key-value store (a .bdb file for example) into another kv_io backend."""
+import argparse
+import sys
+import time
+import kv_io
+
+__author__ = "Bogdan Kirilenko, 2018."
+
+
+def eprint(msg, end="\n"):
+    """Like print but for stderr."""
+    sys.stderr.write(msg + end)
+
+
+def die(msg, rc=1):
+    """Write msg to stderr and abort program."""
+    eprint(msg)
+    sys.exit(rc)
+
+
+def parse_args():
+    """Read args, check."""
+    app = argparse.ArgumentParser()
+    app.add_argument("input", help="Store to read")
+    app.add_argument("output", help="Store to create, replaced if exists")
+    app.add_argument("backend", choices=kv_io.BACKENDS, help="Backend of the output")
+    app.add_argument("--input_backend", choices=("auto",) + kv_io.BACKENDS, default="auto",
+                     help="Backend of the input, guessed from the file by default")
+    # print help if there are no args
+    if len(sys.argv) < 2:
+        app.print_help()
+        sys.exit(0)
+    args = app.parse_args()
+    return args
+
+
+def convert(input_path, output_path, backend, input_backend="auto"):
+    """Copy all pairs, return their number."""
+    src = kv_io.open_db(input_path, input_backend)
+    counter = [0]
+
+    def counted(items):
+        for item in items:
+            counter[0] += 1
+            yield item
+
+    kv_io.write_db(output_path, counted(src.items()), backend)
+    src.close()
+    return counter[0]
+
+
+def main():
+    """Entry point."""
+    args = parse_args()
+    t0 = time.perf_counter()
+    try:
+        num = convert(args.input, args.output, args.backend, args.input_backend)
+    except ValueError as err:  # backend is not available
+        die(str(err))
+    eprint("{0} pairs copied in {1:.2f} s".format(num, time.perf_counter() - t0))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""Synonymous and non-synonymous neighbours of codons.
+
+A neighbour differs from the codon in one base. Neighbours coding the same
+amino acid are synonymous, the rest (stops included) are non-synonymous.
+The table is filled once at import, masked codons (NNN, ---, stops) and
+anything which is not an upper case ACGT codon have no neighbours.
+"""
+from itertools import product
+from seq_utils import GENETIC_CODE
+
+__author__ = "Bogdan Kirilenko, 2018."
+BASES = "ACGT"
+MASKED = ("NNN", "---", "TAG", "TGA", "TAA")
+NO_ALTS = ((), ())
+
+
+def codon_alts(codon):
+    """Return (synonymous, non-synonymous) tuples of neighbours of the codon."""
+    syn, nsyn = [], []
+    for pos in range(3):
+        for base in BASES:
+            if base == codon[pos]:
+                continue
+            alt = codon[:pos] + base + codon[pos + 1:]
+            syn.append(alt) if GENETIC_CODE[alt] == GENETIC_CODE[codon] else nsyn.append(alt)
+    return tuple(syn), tuple(nsyn)
+
+
+ALTS = {"".join(codon): codon_alts("".join(codon)) for codon in product(BASES, repeat=3)}
+ALTS.update({codon: NO_ALTS for codon in MASKED})
+
+
+def get_alts(codon):
+    """Return (synonymous, non-synonymous) neighbours of the codon."""
+    return ALTS.get(codon, NO_ALTS)
+
+
+if __name__ == "__main__":
+    # print the table: codon, AA, numbers of synonymous and non-synonymous neighbours
+    for codon, (syn, nsyn) in sorted(ALTS.items()):
+        print("{0}\t{1}\t{2}\t{3}".format(codon, GENETIC_CODE[codon], len(syn), len(nsyn)))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Shared fasta reading and indexing.
+
+Index lines are like samtools .fai:
+name<tab>seq_len<tab>offset<tab>line_bases<tab>line_width
+Except that name is the whole header line, as the tools here use it,
+so the index has its own suffix and never replaces (or reads) a .fai.
+The first line keeps the fasta size: the index is rebuilt if it changed.
+Before a record is read, its header line is checked to be right before
+the offset; a stale index is rebuilt then.
+Records with irregular line lengths get line_bases = line_width = 0,
+they are still fetched with one seek but read line by line.
+"""
+import mmap
+import os
+import sys
+from collections import Counter, namedtuple
+
+INDEX_SUFFIX = ".fidx"
+SIZE_FIELD = "#fasta_size"
+FaiRecord = namedtuple("FaiRecord", ["length", "offset", "line_bases", "line_width"])
+
+
+def iter_fasta(fasta_file, rm=""):
+    """Yield (header, sequence) pairs one record at a time."""
+    input_stream = open(fasta_file, "r") if fasta_file != "stdin" else sys.stdin
+    to_rm = rm.split(",")  # make removal list
+    header, lines = None, []  # current record
+    for line in input_stream:
+        line = line[:-1] if line.endswith("\n") else line
+        if line.startswith(">"):  # a new record starts, release the previous one
+            if header is not None and header not in to_rm and len(lines) > 0:
+                yield header, "".join(lines)
+            header, lines = line[1:], []
+            continue
+        elif header is None and line != "":
+            raise ValueError("Error! {0} is not a fasta file: it doesn't start with >".format(fasta_file))
+        lines.append(line) if line != "" else None
+    # the last record
+    if header is not None and header not in to_rm and len(lines) > 0:
+        yield header, "".join(lines)
+    input_stream.close() if fasta_file != "stdin" else None
+
+
+def read_fasta(fasta_file, rm=""):
+    """Read fasta, return dict and order."""
+    sequences = {}  # accumulate data here
+    order = []  # to have ordered list
+    for header, sequence in iter_fasta(fasta_file, rm):
+        sequences[header] = sequence
+        order.append(header)
+    if len(sequences) == 0:
+        raise ValueError("There are not fasta-formatted sequences in {0}!".format(fasta_file))
+    if len(sequences.keys()) != len(order):  # it is possible in case of non-unique headers
+        err = "Error! Sequences names must be unique! There are" \
+              " {0} sequences and {1} unique names!\n".format(len(order), len(sequences.keys()))
+        intersect = [k for k, v in Counter(order).items() if v > 1]
+        err += "Intersections are:\n{0}".format(",".join(intersect))
+        raise ValueError(err)
+    return sequences, order
+
+
+def build_index(fasta_file):
+    """Scan fasta once, return header: FaiRecord dict in the file order."""
+    index = {}
+    header, offset, length = None, 0, 0
+    line_sizes = []  # (bases, bytes) for each line of the current record
+    blank_seen, irregular = False, False  # blank lines are allowed only at the end of a record
+
+    def add_record():
+        if header is None or length == 0:  # empty records are skipped, as in read_fasta
+            return
+        if header in index:
+            raise ValueError("Error! Sequences names must be unique! "
+                             "{0} appears twice in {1}".format(header, fasta_file))
+        line_bases, line_width = line_sizes[0]
+        # all lines but the last one must be of the same length to compute offsets
+        regular = not irregular and all(x == line_sizes[0] for x in line_sizes[:-1]) \
+            and line_sizes[-1][0] <= line_bases
+        index[header] = FaiRecord(length, offset, line_bases, line_width) if regular \
+            else FaiRecord(length, offset, 0, 0)
+
+    pos = 0
+    with open(fasta_file, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                add_record()
+                header = line[1:].rstrip(b"\r\n").decode("utf-8")
+                offset, length, line_sizes = pos + len(line), 0, []
+                blank_seen, irregular = False, False
+            elif header is None and line.strip():
+                raise ValueError("Error! {0} is not a fasta file: it doesn't start with >".format(fasta_file))
+            else:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases == 0:
+                    blank_seen = True
+                elif header is not None:
+                    irregular = irregular or blank_seen
+                    line_sizes.append((bases, len(line)))
+                    length += bases
+            pos += len(line)
+        add_record()
+    if len(index) == 0:
+        raise ValueError("There are not fasta-formatted sequences in {0}!".format(fasta_file))
+    return index
+
+
+def save_index(index, index_file, fasta_size):
+    """Write the fasta size and .fai-like lines."""
+    with open(index_file, "w") as f:
+        f.write("{0}\t{1}\n".format(SIZE_FIELD, fasta_size))
+        for name, rec in index.items():
+            f.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(name, *rec))
+
+
+def load_index(index_file):
+    """Read index file, return fasta size and header: FaiRecord dict.
+
+    Size is None if the file is not an index of ours.
+    """
+    index = {}
+    with open(index_file, "r") as f:
+        size_line = f.readline().rstrip("\n").split("\t")
+        if len(size_line) != 2 or size_line[0] != SIZE_FIELD:
+            return None, index
+        for line in f:
+            name, *nums = line.rstrip("\n").rsplit("\t", 4)  # names might contain tabs
+            index[name] = FaiRecord(*[int(x) for x in nums])
+    return int(size_line[1]), index
+
+
+def rebuild_index(fasta_file):
+    """Build and save the index."""
+    index = build_index(fasta_file)
+    try:  # reuse it next time, if we can
+        save_index(index, fasta_file + INDEX_SUFFIX, os.path.getsize(fasta_file))
+    except OSError:
+        pass
+    return index
+
+
+def get_index(fasta_file):
+    """Load index if it is up to date, build and save it otherwise."""
+    index_file = fasta_file + INDEX_SUFFIX
+    if os.path.isfile(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(fasta_file):
+        size, index = load_index(index_file)
+        if size == os.path.getsize(fasta_file):
+            return index
+    return rebuild_index(fasta_file)
+
+
+def header_ok(before, read_from, name):
+    """Check that bytes before a record (read from position read_from) end with its header line."""
+    if not before.endswith(b"\n"):
+        return False
+    line = before[:-2] if before.endswith(b"\r\n") else before[:-1]
+    header = b">" + name.encode("utf-8")
+    if not line.endswith(header):
+        return False
+    prev = len(line) - len(header) - 1  # the newline before the header
+    return line[prev: prev + 1] == b"\n" if prev >= 0 else read_from == 0
+
+
+def header_span(rec, name):
+    """Return the range of bytes header_ok needs for a record."""
+    return max(rec.offset - len(name.encode("utf-8")) - 4, 0), rec.offset
+
+
+def record_ok(f, rec, name):
+    """Check the header line of a record in a file opened in binary mode."""
+    start, end = header_span(rec, name)
+    f.seek(start)
+    return header_ok(f.read(end - start), start, name)
+
+
+def fetch_seq(f, rec):
+    """Read the sequence for a FaiRecord from a file opened in binary mode."""
+    f.seek(rec.offset)
+    if rec.line_bases > 0:  # regular lines: we know how many bytes to read
+        full_lines, rest = divmod(rec.length, rec.line_bases)
+        raw = f.read(full_lines * rec.line_width + rest)
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode("utf-8")
+    lines = []  # irregular: read line by line until the next record
+    for line in f:
+        if line.startswith(b">"):
+            break
+        lines.append(line.rstrip(b"\r\n"))
+    return b"".join(lines).decode("utf-8")
+
+
+def fetch_seqs(fasta_file, names):
+    """Return name: sequence for the names requested; absent names are skipped."""
+    if fasta_file == "stdin":  # cannot seek there, just scan it
+        wanted = set(names)
+        return {k: v for k, v in iter_fasta(fasta_file) if k in wanted}
+    index, rebuilt = get_index(fasta_file), False
+    sequences = {}
+    with open(fasta_file, "rb") as f:
+        for name in names:
+            rec = index.get(name)
+            if rec is not None and not record_ok(f, rec, name) and not rebuilt:
+                index, rebuilt = rebuild_index(fasta_file), True  # stale index
+                rec = index.get(name)
+            if rec is None:
+                continue
+            sequences[name] = fetch_seq(f, rec)
+    return sequences
+
+
+class MappedFasta:
+    """Random access to indexed fasta sequences through mmap.
+
+    Only the bytes of the requested range are touched,
+    the rest of the file is never read.
+    """
+
+    def __init__(self, fasta_file):
+        """Load or build the index and map the file."""
+        self.fasta_file = fasta_file
+        self.index = get_index(fasta_file)
+        self._f = open(fasta_file, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        """Return headers in the file order."""
+        return list(self.index.keys())
+
+    def seq_len(self, name):
+        """Return length of the sequence."""
+        return self.index[name].length
+
+    def _byte_pos(self, rec, i):
+        """Position in the file of the i-th base of a regular record."""
+        lines, rest = divmod(i, rec.line_bases)
+        return rec.offset + lines * rec.line_width + rest
+
+    def _record_ok(self, name):
+        """Check the header line of a record."""
+        start, end = header_span(self.index[name], name)
+        return header_ok(self._mm[start: end], start, name)
+
+    def check(self):
+        """Check all records, rebuild the index if it is stale."""
+        if not all(self._record_ok(name) for name in self.index):
+            self.index = rebuild_index(self.fasta_file)
+
+    def fetch(self, name, start=0, end=None):
+        """Return sequence[start: end], like a slice (negative values are not supported)."""
+        if name in self.index and not self._record_ok(name):
+            self.index = rebuild_index(self.fasta_file)  # stale: the name might be gone now
+        rec = self.index[name]
+        end = rec.length if end is None else min(end, rec.length)
+        start = min(start, end)
+        if rec.line_bases == 0:  # irregular lines: read the record until the next one
+            rec_end = self._mm.find(b"\n>", rec.offset)
+            raw = self._mm[rec.offset: rec_end if rec_end != -1 else len(self._mm)]
+            return raw.replace(b"\n", b"").replace(b"\r", b"").decode("utf-8")[start: end]
+        raw = self._mm[self._byte_pos(rec, start): self._byte_pos(rec, end)]
+        return raw.replace(b"\n", b"").replace(b"\r", b"").decode("utf-8")
+
+    def columns(self, start=0, end=None, names=None):
+        """Yield (name, sequence[start: end]) for each record, e.g. an alignment window."""
+        for name in names if names is not None else self.index.keys():
+            yield name, self.fetch(name, start, end)
+
+    def close(self):
+        """Unmap and close the file."""
+        self._mm.close()
+        self._f.close()
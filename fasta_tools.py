@@ -5,29 +5,72 @@ import sys
 import os
 import re
 import subprocess
-from collections import Counter, defaultdict
+from collections import defaultdict
+from itertools import compress
+import fasta_io
+from seq_utils import GENETIC_CODE, reverse_complement
 
 __author__ = 'Bogdan Kirilenko, 2018'
 
 # genetic code if translation is needed
-nta = {"TTT": "F", "TTC": "F", "TTA": "L", "TTG": "L",
-       "TCT": "S", "TCC": "S", "TCA": "S", "TCG": "S",
-       "TAT": "Y", "TAC": "Y", "TAA": "*", "TAG": "*",
-       "TGT": "C", "TGC": "C", "TGA": "*", "TGG": "W",
-       "CTT": "L", "CTC": "L", "CTA": "L", "CTG": "L",
-       "CCT": "P", "CCC": "P", "CCA": "P", "CCG": "P",
-       "CAT": "H", "CAC": "H", "CAA": "Q", "CAG": "Q",
-       "CGT": "R", "CGC": "R", "CGA": "R", "CGG": "R",
-       "ATT": "I", "ATC": "I", "ATA": "I", "ATG": "M",
-       "ACT": "T", "ACC": "T", "ACA": "T", "ACG": "T",
-       "AAT": "N", "AAC": "N", "AAA": "K", "AAG": "K",
-       "AGT": "S", "AGC": "S", "AGA": "R", "AGG": "R",
-       "GTT": "V", "GTC": "V", "GTA": "V", "GTG": "V",
-       "GCT": "A", "GCC": "A", "GCA": "A", "GCG": "A",
-       "GAT": "D", "GAC": "D", "GAA": "E", "GAG": "E",
-       "GGT": "G", "GGC": "G", "GGA": "G", "GGG": "G",
-       "---": "-", "NNN": "X"}
-compl = {"A": "T", "T": "A", "G": "C", "C": "G", "N": "N", "-": "-"}
+nta = GENETIC_CODE
+NOT_GAP = bytes([0 if i == ord("-") else 1 for i in range(256)])  # translation table: gap -> 0, else 1
+CODON_CODES = "ACGTN-"  # codons of these letters are translated through CODON_TABLES
+RARE_LETTER = re.compile("[^ACGTNacgt-]")  # codons with other letters go to translate_codon
+SKIP, FRAMESHIFT = 0, 1  # marks in the translated bytes for "" and None of translate_codon
+
+
+def translate_codon(codon, force=False):
+    """Return AA for a codon, "" if it should be skipped or None if it is a frameshift."""
+    AA = nta.get(codon.upper())
+    if AA:
+        return AA
+    if "-" in codon and not force:  # something like AT- | must be ATG or ---
+        return None
+    elif "-" in codon or "N" in codon or "!" in codon:
+        return "X"  # if ATN for example - don't know whatta AA
+    return ""
+
+
+def position_table(weight):
+    """Return bytes.translate table: letter -> its CODON_CODES number * weight."""
+    table = bytearray(256)
+    for code, letter in enumerate(CODON_CODES):
+        table[ord(letter)] = code * weight
+        # lower case n codons get a table value too, but translate_codon
+        # translates them again: n is a RARE_LETTER
+        table[ord(letter.lower())] = code * weight
+    return bytes(table)
+
+
+def codon_table(force=False):
+    """Return bytes.translate table: packed codon index -> AA, SKIP or FRAMESHIFT."""
+    table = bytearray(256)
+    size = len(CODON_CODES)
+    for index in range(size ** 3):
+        codon = CODON_CODES[index // size ** 2] + CODON_CODES[index // size % size] + CODON_CODES[index % size]
+        AA = translate_codon(codon, force)
+        table[index] = FRAMESHIFT if AA is None else SKIP if AA == "" else ord(AA)
+    return bytes(table)
+
+
+# each codon is packed in one byte: first * 36 + second * 6 + third, sums never exceed 215
+POSITION_TABLES = [position_table(len(CODON_CODES) ** 2), position_table(len(CODON_CODES)), position_table(1)]
+CODON_TABLES = {False: codon_table(False), True: codon_table(True)}
+
+
+def translate_seq(seq, force=False):
+    """Translate a sequence of complete codons, return bytes with SKIP and FRAMESHIFT marks."""
+    codons_num = len(seq) // 3
+    raw = seq.encode("latin-1", "replace")
+    # add the three positions of all codons at once as big numbers, a byte per codon, no carry
+    packed = sum(int.from_bytes(raw[pos::3].translate(table), "big") for pos, table in enumerate(POSITION_TABLES))
+    aa_seq = bytearray(packed.to_bytes(codons_num, "big").translate(CODON_TABLES[force]))
+    for match in RARE_LETTER.finditer(seq):  # lower case n, ! etc., rare
+        codon_num = match.start() // 3
+        AA = translate_codon(seq[codon_num * 3: codon_num * 3 + 3], force)
+        aa_seq[codon_num] = FRAMESHIFT if AA is None else SKIP if AA == "" else ord(AA)
+    return aa_seq
 
 
 def die(msg):
@@ -55,39 +98,10 @@ def test_reachable(path):
 
 def read_fasta(fasta_file, show_headers=False, rm=""):
     """Read fasta, return dict and type."""
-    # open the file
-    input_stream = open(fasta_file, "r") if fasta_file != "stdin" else sys.stdin
-    # with open(input_stream, "r") as f:
-    fasta_data = input_stream.read().split(">")
-    input_stream.close()
-    # TODO check if fasta file is correct
-    assert fasta_data[0] == ""  # if a file starts with > it should be empty
-    del fasta_data[0]  # remove it "" we don't need that
-    sequences = {}  # accumulate data here
-    order = []  # to have ordered list
-    # read line by line
-
-    to_rm = rm.split(",")  # make removal list
-
-    for elem in fasta_data:
-        raw_lines = elem.split("\n")
-        header = raw_lines[0]  # it must be first ['capHir1', 'ATGCCGCGCCAATTCCCCAAGCTGA... ]
-        if header in to_rm:
-            continue  # do not add if we don't need it
-        lines = [x for x in raw_lines[1:] if x != ""]  # separate nucleotide-containing lines
-        if len(lines) == 0:  # it is a mistake - empty sequene --> get rid of
-            continue
-        fasta_content = "".join(lines)
-        sequences[header] = fasta_content
-        order.append(header)
-    if len(sequences) == 0:
-        die("There are not fasta-formatted sequences in {0}!".format(fasta_file))
-    if len(sequences.keys()) != len(order):  # it is possible in case of non-unique headers
-        err = "Error! Sequences names must be unique! There are" \
-              " {0} sequences and {1} unique names!\n".format(len(sequences.keys()), len(order))
-        intersect = [k for k, v in Counter(order).items() if v > 1]
-        err += "Intersections are:\n{0}".format(",".join(intersect))
-        die(err)
+    try:
+        sequences, order = fasta_io.read_fasta(fasta_file, rm)
+    except ValueError as err:  # not a fasta, empty or non-unique names
+        die(str(err))
     if show_headers:  # just print all the >'s and interrupt
         sys.stdout.write(",".join(order) + "\n")
         sys.exit(0)
@@ -95,6 +109,27 @@ def read_fasta(fasta_file, show_headers=False, rm=""):
     return sequences, order
 
 
+def iter_window(fasta_file, t_from, t_to, rm=""):
+    """Yield (header, sequence[t_from: t_to]) reading only the window."""
+    to_rm = rm.split(",")  # make removal list
+    try:
+        fasta = fasta_io.MappedFasta(fasta_file)
+        fasta.check()  # we read all records anyway
+    except ValueError as err:  # not a fasta, empty or non-unique names
+        die(str(err))
+    order = [x for x in fasta.names() if x not in to_rm]
+    if len(order) == 0:
+        die("There are not fasta-formatted sequences in {0}!".format(fasta_file))
+    # check is the limits are violated, as trim_data does
+    seq_len = fasta.seq_len(order[0])
+    t_to = seq_len if t_to == 0 else t_to  # 0 is default
+    if t_from >= seq_len or t_to > seq_len:  # otherwise it is index error
+        die("Error! Trim borders are outside the sequence length! {0} letters".format(seq_len))
+    for name, seq in fasta.columns(t_from, t_to, order):
+        yield name, seq
+    fasta.close()
+
+
 def read_phylip(input_file, show_headers=False, rm=""):
     """Read phylip format."""
     f = open(input_file, "r")
@@ -197,16 +232,52 @@ def fill(data):
     return filled
 
 
-def rm_ref_cols(data, ref_name):
-    """Remove cols where ref has gaps."""
-    ref_seq = data.get(ref_name)
+def ref_mask(data, ref_names, strict=False):
+    """Return bytes with 1 for each column to keep and 0 where references have gaps.
+
+    With several references a column is removed if all of them have a gap here,
+    or if any of them has a gap in the strict mode.
+    """
+    # a byte per column, 0 or 1 from translate(NOT_GAP), read as one little-endian int:
+    # & and | of these ints combine all the columns at once, bytes never carry
+    mask, length = None, 0
+    for ref_name in ref_names:
+        ref_seq = data.get(ref_name)
+        die("Error! Seq {} not found!".format(ref_name)) if not ref_seq else None
+        seq_mask = int.from_bytes(ref_seq.encode().translate(NOT_GAP), "little")
+        length = max(length, len(ref_seq))
+        if mask is None:
+            mask = seq_mask
+        else:
+            mask = mask & seq_mask if strict else mask | seq_mask
+    return mask.to_bytes(length, "little")  # shorter references: missing high bytes are 0
+
+
+def rm_ref_cols(data, ref_names, strict=False):
+    """Remove cols where ref has gaps, return updated data and kept [start, end) intervals."""
     updated = {}
-    die("Error! Seq {} not found!".format(ref_name)) if not ref_seq else None
-    ref_ok = [n for n, c in enumerate(ref_seq) if c != "-"]
+    kept = ref_mask(data, ref_names, strict)
+    ref_ok = [m.span() for m in re.finditer(b"\x01+", kept)]
+    # joining slices is fast if the kept intervals are long, otherwise filter letter by letter
+    by_slices = len(ref_ok) * 8 < len(kept)
     for name, seq in data.items():
-        new_seq = "".join([seq[i] for i in ref_ok])
+        if by_slices:
+            new_seq = "".join([seq[start: end] for start, end in ref_ok])
+        else:
+            new_seq = "".join(compress(seq, kept))
         updated[name] = new_seq
-    return updated
+    return updated, ref_ok
+
+
+def save_col_map(intervals, output):
+    """Save old -> new coordinates of the kept columns."""
+    f = open(output, "w") if output != "stdout" else sys.stderr  # stdout might be taken by fasta
+    f.write("#old_start\told_end\tnew_start\n")
+    new_start = 0
+    for start, end in intervals:
+        f.write("{0}\t{1}\t{2}\n".format(start, end, new_start))
+        new_start += end - start
+    f.close() if output != "stdout" else None
 
 
 def change_case(data, up, lo):
@@ -224,29 +295,19 @@ def translate(data, force=False):
 
     for name, seq in data.items():
         # len must be % 3 == 0!
-        if not len(seq) % 3 == 0 and not force:
+        tail = len(seq) % 3
+        if not tail == 0 and not force:
             die("Error! Codon alignment is required for translation! {} is out of frame".format(name))
-        codons = parts(seq, n=3)  # split to codons
-        # get corresponding AA for each
-        aa_seq = ""  # accumulate here
-        for codon in codons:
-            AA = nta.get(codon.upper())
-            if AA:  # continue if it is OK here
-                aa_seq += AA
-                continue
-            # kill if gaps in codon:
-            if "-" in codon and not force:  # something like AT- | must be ATG or ---
-                sys.stderr.write("Sequence {} contains frameshifts!\n".format(name))
-                die("Error! Codon alignment is required!")
-            if "-" in codon and force:
-                aa_seq += "X"
-            elif "N" in codon:  # if ATN for example - don't know whatta AA
-                aa_seq += "X"
-            elif "!" in codon:
-                aa_seq += "X"
-
+        aa_seq = translate_seq(seq[:len(seq) - tail], force)
+        if tail:  # incomplete codon
+            AA = translate_codon(seq[-tail:], force)
+            aa_seq.append(FRAMESHIFT if AA is None else SKIP if AA == "" else ord(AA))
+        # kill if gaps in codon:
+        if FRAMESHIFT in aa_seq:  # never happens with force
+            sys.stderr.write("Sequence {} contains frameshifts!\n".format(name))
+            die("Error! Codon alignment is required!")
         # save new seq
-        translated[name] = aa_seq
+        translated[name] = aa_seq.replace(bytes([SKIP]), b"").decode("latin-1")
     return translated
 
 
@@ -296,27 +357,99 @@ def save_fasta(data, order, output):
     f.close() if output != "stdout" else None
 
 
+def stream_fasta(records, output):
+    """Save one_line fasta record-by-record, as soon as each record is ready."""
+    if output == "0":  # skip saving, but the records must be processed anyway
+        for _ in records:
+            pass
+        return
+    f = open(output, "w") if output != "stdout" else sys.stdout  # open the output file
+    for head, seq in records:
+        f.write(">{0}\n".format(head))
+        f.write("{0}\n".format(seq))
+    f.close() if output != "stdout" else None
+
+
 def invert_complement(data):
     """Invert complement sequences."""
     inverted = {}
     for name, seq in data.items():
-        seq_inv = seq[::-1]
-        seq_compl = "".join([compl.get(c) if compl.get(c) else c for c in seq_inv])
-        inverted[name] = seq_compl
+        inverted[name] = reverse_complement(seq)
     return inverted
 
 
+def check_unique_names(fasta_file, rm=""):
+    """Die if sequence names are not unique; the file is read a record at a time."""
+    seen = set()  # only headers are kept
+    for name, _ in fasta_io.iter_fasta(fasta_file, rm):
+        if name in seen:
+            die("Error! Sequences names must be unique! {0} appears twice.".format(name))
+        seen.add(name)
+
+
+def process_stream(records, args, trimming=True):
+    """Apply per-record operations to (header, sequence) pairs lazily, names must be unique."""
+    trimming = trimming and (args.trim_to > 0 or args.trim_from > 0)
+    t_to = args.trim_to
+    records_num = 0
+    for name, seq in records:
+        records_num += 1
+        data = {name: seq}
+        # the same order of operations as in the buffered mode
+        if args.up or args.lo:
+            data = change_case(data, args.up, args.lo)
+        data = fill(data) if args.fill else data
+        data = translate(data, args.force) if args.trans else data
+        if trimming and records_num == 1:  # borders are checked against the first sequence
+            t_to = len(data[name]) if t_to == 0 else t_to
+            data = trim_data(data, args.trim_from, t_to)
+        elif trimming:
+            data = {name: data[name][args.trim_from: t_to]}
+        data = misalign(data) if args.misalign else data
+        data = invert_complement(data) if args.inv else data
+        data = rearrange_fasta(data, args.fasta_scale)
+        yield name, data[name]
+    if records_num == 0:
+        die("There are not fasta-formatted sequences in {0}!".format(args.input))
+
+
 def main(args):
     """Entry point."""
     # test if output files are reachable | if needed
     test_reachable(args.output) if args.input != args.output and args.output != "0" else None
     test_reachable(args.tree) if args.tree else None
 
+    # these operations need all the sequences at once
+    need_buffer = args.phylip or args.vars or args.sort or args.vs_ref or args.tree \
+        or args.copy or args.paste or args.input == args.output or args.input == "stdin"
+    # trimmed window can be read directly if nothing changes coordinates before trimming
+    map_window = (args.trim_to > 0 or args.trim_from > 0) and args.input != "stdin" \
+        and not (args.phylip or args.vars or args.trans or args.vs_ref)
+    if args.stream and not need_buffer:
+        records = iter_window(args.input, args.trim_from, args.trim_to, args.rm) if map_window \
+            else fasta_io.iter_fasta(args.input, args.rm)
+        try:  # names are checked before anything is written
+            if map_window:  # building the index checks them, iter_window reuses it
+                fasta_io.get_index(args.input)
+            else:
+                check_unique_names(args.input, args.rm)
+            stream_fasta(process_stream(records, args, trimming=not map_window), args.output)
+        except ValueError as err:  # not a fasta
+            die(str(err))
+        sys.exit(0)
+    elif args.stream:
+        sys.stderr.write("Warning! --stream cannot be used with --phylip, -v, --sort, --vs_ref, "
+                         "--tree, --copy/--paste, stdin or the same input and output. "
+                         "Reading the whole file instead.\n")
+
     # read initial fasta and check the format
-    if not args.phylip:
-        data, order = read_fasta(args.input, args.vars, args.rm)  # interrupt if -v
-    else:  # it is phylip
+    if args.phylip:
         data, order = read_phylip(args.input, args.vars, args.rm)
+    elif map_window:  # already trimmed
+        data = dict(iter_window(args.input, args.trim_from, args.trim_to, args.rm))
+        order = list(data.keys())
+    else:
+        data, order = read_fasta(args.input, args.vars, args.rm)  # interrupt if -v
 
     if args.up or args.lo:  # up/lo case required
         data = change_case(data, args.up, args.lo)
@@ -327,7 +460,9 @@ def main(args):
 
     # sort if required
     order = list(sorted(order)) if args.sort else order
-    data = data if not args.vs_ref else rm_ref_cols(data, args.vs_ref)
+    if args.vs_ref:
+        data, ref_ok = rm_ref_cols(data, args.vs_ref.split(","), args.vs_ref_strict)
+        save_col_map(ref_ok, args.col_map) if args.col_map else None
     # fill if requered
     data = fill(data) if args.fill else data
 
@@ -342,7 +477,8 @@ def main(args):
                          format(",".join(not_found))) if len(not_found) > 0 else None
 
     # apply trimming if requered
-    data = trim_data(data, args.trim_from, args.trim_to) if args.trim_to > 0 or args.trim_from > 0 else data
+    trimming = (args.trim_to > 0 or args.trim_from > 0) and not map_window
+    data = trim_data(data, args.trim_from, args.trim_to) if trimming else data
 
     # misalign if required
     if args.misalign:
@@ -380,9 +516,18 @@ if __name__ == "__main__":
     app.add_argument("--paste", type=str, default=None, help="Paste copied sequence as...")
     app.add_argument("--fill", action="store_true", dest="fill", help="Replace speces with N's.")
     app.add_argument("--force", "-f", action="store_true", dest="force", help="Ignore errors.")
-    app.add_argument("--vs_ref", type=str, default=None, help="Remove columns where ref has gaps.")
+    app.add_argument("--vs_ref", type=str, default=None, help="Remove columns where ref has gaps. "
+                     "Comma-separated list: remove columns where all of them have gaps.")
+    app.add_argument("--vs_ref_strict", action="store_true", dest="vs_ref_strict",
+                     help="With several --vs_ref: remove columns where any of them has a gap.")
+    app.add_argument("--col_map", type=str, default=None, help="With --vs_ref: save kept columns as "
+                     "old_start, old_end, new_start (0-based, half-open) table.")
     app.add_argument("--misalign", "--mn", action="store_true", dest="misalign", help="Return not aligned fasta.")
     app.add_argument("--inv", action="store_true", dest="inv", help="Invert complement.")
+    app.add_argument("--stream", action="store_true", dest="stream",
+                     help="Process and write sequences one by one, do not keep the whole file in memory. "
+                     "Names are checked to be unique before writing, so the input is read twice; "
+                     "stdin is read as a whole.")
 
     if len(sys.argv) < 3:  # close if very few argumants
         app.print_help()
@@ -1,14 +1,24 @@
 #!/usr/bin/env python3
-"""Make reverse complement sequence."""
+"""Make reverse complement sequence.
+
+Give a sequence as argument, or - / nothing to read fasta from stdin.
+"""
 import sys
+import fasta_io
+from seq_utils import reverse_complement
 
-try:
-    seq = sys.argv[1]
-except IndexError:
-    sys.exit("Usage: {} [DNA sequence]".format(sys.argv[0]))
+seq = sys.argv[1] if len(sys.argv) > 1 else "-"
+if seq in ("-h", "--help"):
+    sys.exit("Usage: {} [DNA sequence] or fasta | {} -".format(sys.argv[0], sys.argv[0]))
 
-complemenletters = {"A": "T", "T": "A", "G": "C", "C": "G", "-": "-", "N": "N"}
-reverse = seq[::-1]
-reverse_complement = "".join([complemenletters.get(c) if complemenletters.get(c) else "X" for c in reverse])
-print(reverse_complement)
+if seq != "-":  # a single sequence
+    print(reverse_complement(seq))
+    sys.exit(0)
 
+if sys.stdin.isatty():  # nothing to read
+    sys.exit("Usage: {} [DNA sequence] or fasta | {} -".format(sys.argv[0], sys.argv[0]))
+try:  # stream fasta record by record
+    for header, record_seq in fasta_io.iter_fasta("stdin"):
+        sys.stdout.write(">{0}\n{1}\n".format(header, reverse_complement(record_seq)))
+except ValueError as err:  # not a fasta
+    sys.exit(str(err))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Key-value stores behind bdb_to_stdout: Berkeley DB, LMDB, SQLite and dbm.
+
+All of them are opened the same way and give:
+get(key) -> value or None, items(start) -> sorted (key, value) pairs
+from the first key >= start, and close(). Keys and values are bytes.
+Berkeley DB and LMDB need bsddb3 and lmdb packages, SQLite and dbm are in
+the standard library. dbm files are not ordered: items() sorts all keys first.
+"""
+import dbm
+import os
+import sqlite3
+try:
+    import bsddb3
+except ImportError:  # not installed, Berkeley DB files cannot be read
+    bsddb3 = None
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
+BACKENDS = ("bdb", "lmdb", "sqlite", "dbm")
+SQLITE_SIGNATURE = b"SQLite format 3\x00"
+LMDB_MAP_SIZE = 1 << 40  # address space only, the file grows as needed
+WRITE_BATCH = 100000  # pairs written in one transaction
+
+
+class BerkeleyDB:
+    """Berkeley DB btree file."""
+
+    def __init__(self, path):
+        """Open read-only."""
+        self.db = bsddb3.btopen(path, "r")
+
+    def get(self, key):
+        """Return value or None."""
+        try:
+            return self.db[key]
+        except KeyError:
+            return None
+
+    def items(self, start=None):
+        """Yield (key, value) pairs in the btree order."""
+        db = self.db
+        try:  # set_location finds the smallest key >= start
+            item = db.set_location(start) if start is not None else db.first()
+        except KeyError:  # empty db or nothing after start
+            return
+        while True:
+            yield item
+            try:
+                item = db.next()
+            except KeyError:  # the last one
+                return
+
+    def close(self):
+        """Close the file."""
+        self.db.close()
+
+    @staticmethod
+    def write(path, items):
+        """Create path with the pairs given."""
+        db = bsddb3.btopen(path, "n")
+        for key, value in items:
+            db[key] = value
+        db.close()
+
+
+class LmdbDB:
+    """LMDB memory-mapped store, a single file (no subdirectory)."""
+
+    def __init__(self, path):
+        """Open read-only, without the lock file."""
+        self.env = lmdb.open(path, subdir=False, readonly=True, lock=False)
+
+    def get(self, key):
+        """Return value or None."""
+        with self.env.begin() as txn:  # a short transaction: safe with threads
+            return txn.get(key)
+
+    def items(self, start=None):
+        """Yield (key, value) pairs in the key order."""
+        with self.env.begin() as txn:
+            cursor = txn.cursor()
+            found = cursor.set_range(start) if start is not None else cursor.first()
+            if not found:
+                return
+            for item in cursor.iternext():
+                yield item
+
+    def close(self):
+        """Close the environment."""
+        self.env.close()
+
+    @staticmethod
+    def write(path, items):
+        """Create path with the pairs given."""
+        for old_file in (path, path + "-lock"):  # lmdb.open would add to an existing store
+            if os.path.exists(old_file):
+                os.remove(old_file)
+        env = lmdb.open(path, subdir=False, map_size=LMDB_MAP_SIZE)
+        txn, num = env.begin(write=True), 0
+        for key, value in items:
+            txn.put(key, value)
+            num += 1
+            if num % WRITE_BATCH == 0:
+                txn.commit()
+                txn = env.begin(write=True)
+        txn.commit()
+        env.close()
+
+
+class SqliteDB:
+    """SQLite table kv(key, value), blobs are compared byte by byte as in a btree."""
+
+    def __init__(self, path):
+        """Open read-only, the connection might be used by the server threads."""
+        self.conn = sqlite3.connect("file:{0}?mode=ro".format(path), uri=True, check_same_thread=False)
+
+    def get(self, key):
+        """Return value or None."""
+        row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def items(self, start=None):
+        """Yield (key, value) pairs in the key order."""
+        if start is None:
+            return iter(self.conn.execute("SELECT key, value FROM kv ORDER BY key"))
+        return iter(self.conn.execute("SELECT key, value FROM kv WHERE key >= ? ORDER BY key", (start,)))
+
+    def close(self):
+        """Close the connection."""
+        self.conn.close()
+
+    @staticmethod
+    def write(path, items):
+        """Create path with the pairs given."""
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode = OFF")  # a new file: nothing to roll back
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("CREATE TABLE kv (key BLOB PRIMARY KEY, value BLOB) WITHOUT ROWID")
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= WRITE_BATCH:
+                conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?)", batch)
+                batch = []
+        conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?)", batch)
+        conn.commit()
+        conn.close()
+
+
+class DbmDB:
+    """Any dbm flavour Python has; keys are not ordered."""
+
+    def __init__(self, path):
+        """Open read-only."""
+        self.db = dbm.open(path, "r")
+
+    def get(self, key):
+        """Return value or None."""
+        return self.db.get(key)
+
+    def items(self, start=None):
+        """Yield (key, value) pairs in the key order, all keys are sorted first."""
+        for key in sorted(self.db.keys()):
+            if start is None or key >= start:
+                yield key, self.db[key]
+
+    def close(self):
+        """Close the file."""
+        self.db.close()
+
+    @staticmethod
+    def write(path, items):
+        """Create path with the pairs given."""
+        db = dbm.open(path, "n")
+        for key, value in items:
+            db[key] = value
+        db.close()
+
+
+BACKEND_CLASSES = {"bdb": BerkeleyDB, "lmdb": LmdbDB, "sqlite": SqliteDB, "dbm": DbmDB}
+REQUIRED_MODULES = {"bdb": ("bsddb3", bsddb3), "lmdb": ("lmdb", lmdb)}  # None if not installed
+
+
+def available_backends():
+    """Return backends which can be used here."""
+    return [x for x in BACKENDS if x not in REQUIRED_MODULES or REQUIRED_MODULES[x][1] is not None]
+
+
+def guess_backend(path):
+    """Guess the backend by the file content, Berkeley DB if nothing else fits."""
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            if f.read(len(SQLITE_SIGNATURE)) == SQLITE_SIGNATURE:
+                return "sqlite"
+    if path.endswith((".lmdb", ".mdb")):
+        return "lmdb"
+    if dbm.whichdb(path) in ("dbm.gnu", "dbm.ndbm", "dbm.dumb"):
+        return "dbm"
+    return "bdb"
+
+
+def check_backend(backend):
+    """Raise ValueError if the backend is unknown or its module is not installed."""
+    if backend not in BACKEND_CLASSES:
+        raise ValueError("Unknown backend {0}, choose one of {1}".format(backend, ", ".join(BACKENDS)))
+    if backend in REQUIRED_MODULES and REQUIRED_MODULES[backend][1] is None:
+        raise ValueError("{0} backend needs {1} module installed".format(backend, REQUIRED_MODULES[backend][0]))
+
+
+def open_db(path, backend="auto"):
+    """Open a store for reading."""
+    backend = guess_backend(path) if backend == "auto" else backend
+    check_backend(backend)
+    return BACKEND_CLASSES[backend](path)
+
+
+def write_db(path, items, backend):
+    """Create a store of the backend with (key, value) pairs."""
+    check_backend(backend)
+    BACKEND_CLASSES[backend].write(path, items)
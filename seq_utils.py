@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""Small sequence operations shared by the tools."""
+
+# standard genetic code, --- and NNN are for alignments
+GENETIC_CODE = {"TTT": "F", "TTC": "F", "TTA": "L", "TTG": "L",
+                "TCT": "S", "TCC": "S", "TCA": "S", "TCG": "S",
+                "TAT": "Y", "TAC": "Y", "TAA": "*", "TAG": "*",
+                "TGT": "C", "TGC": "C", "TGA": "*", "TGG": "W",
+                "CTT": "L", "CTC": "L", "CTA": "L", "CTG": "L",
+                "CCT": "P", "CCC": "P", "CCA": "P", "CCG": "P",
+                "CAT": "H", "CAC": "H", "CAA": "Q", "CAG": "Q",
+                "CGT": "R", "CGC": "R", "CGA": "R", "CGG": "R",
+                "ATT": "I", "ATC": "I", "ATA": "I", "ATG": "M",
+                "ACT": "T", "ACC": "T", "ACA": "T", "ACG": "T",
+                "AAT": "N", "AAC": "N", "AAA": "K", "AAG": "K",
+                "AGT": "S", "AGC": "S", "AGA": "R", "AGG": "R",
+                "GTT": "V", "GTC": "V", "GTA": "V", "GTG": "V",
+                "GCT": "A", "GCC": "A", "GCA": "A", "GCG": "A",
+                "GAT": "D", "GAC": "D", "GAA": "E", "GAG": "E",
+                "GGT": "G", "GGC": "G", "GGA": "G", "GGG": "G",
+                "---": "-", "NNN": "X"}
+
+# IUPAC complements, lower case (soft-masked) letters stay lower case
+# anything else (gaps, X, etc.) is kept as is
+COMPL_FROM = "ACGTURYKMSWBDHVNacgturykmswbdhvn"
+COMPL_TO = "TGCAAYRMKSWVHDBNtgcaayrmkswvhdbn"
+COMPL_TABLE = str.maketrans(COMPL_FROM, COMPL_TO)
+COMPL_BYTES_TABLE = bytes.maketrans(COMPL_FROM.encode(), COMPL_TO.encode())
+
+
+def reverse_complement(seq):
+    """Return reverse complement of a str or bytes sequence."""
+    if isinstance(seq, bytes):
+        return seq.translate(COMPL_BYTES_TABLE)[::-1]
+    return seq.translate(COMPL_TABLE)[::-1]
+
+
+def translate(seq):
+    """Translate a CDS; codons out of GENETIC_CODE are X, incomplete last codon is skipped."""
+    bases = iter(seq.upper())  # zip of the same iterator gives codons
+    return "".join([GENETIC_CODE.get(a + b + c, "X") for a, b, c in zip(bases, bases, bases)])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""Read sequences from a 2bit file, no dependencies.
+
+A drop-in for the part of twobitreader we use:
+TwoBitFile(path)[chrom][start: end] returns the sequence of [start, end),
+N blocks as N and soft-masked regions in lower case.
+The file is memory-mapped, only the bytes of the requested range are decoded.
+"""
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+SIGNATURE = 0x1A412743
+# each byte packs 4 bases, 2 bits per base: T C A G
+BYTE_TO_BASES = ["".join("TCAG"[byte >> shift & 3] for shift in (6, 4, 2, 0)) for byte in range(256)]
+
+
+class TwoBitError(Exception):
+    """Broken or not a 2bit file."""
+
+
+def apply_blocks(seq, start, block_starts, block_sizes, func):
+    """Apply func to the parts of seq (starting at start) covered by blocks."""
+    end = start + len(seq)
+    i = max(bisect_right(block_starts, start) - 1, 0)  # the block which might cover start
+    pieces, pos = [], start
+    while i < len(block_starts) and block_starts[i] < end:
+        b_start = max(block_starts[i], start)
+        b_end = min(block_starts[i] + block_sizes[i], end)
+        i += 1
+        if b_end <= b_start:
+            continue
+        pieces.append(seq[pos - start: b_start - start])
+        pieces.append(func(seq[b_start - start: b_end - start]))
+        pos = b_end
+    if not pieces:  # nothing to change
+        return seq
+    pieces.append(seq[pos - start:])
+    return "".join(pieces)
+
+
+class TwoBitSequence:
+    """One sequence of a 2bit file, sliced like a string."""
+
+    def __init__(self, mm, offset, byteorder):
+        """Read the sequence header: size, N blocks and mask blocks."""
+        self._mm = mm
+        dna_size, n_count = struct.unpack_from(byteorder + "II", mm, offset)
+        offset += 8
+        self._n_starts, self._n_sizes, offset = self._read_blocks(offset, n_count, byteorder)
+        mask_count = struct.unpack_from(byteorder + "I", mm, offset)[0]
+        offset += 4
+        self._mask_starts, self._mask_sizes, offset = self._read_blocks(offset, mask_count, byteorder)
+        self._dna_offset = offset + 4  # reserved field
+        self._dna_size = dna_size
+
+    def _read_blocks(self, offset, count, byteorder):
+        """Return block starts, sizes arrays and the offset after them."""
+        starts = array("I", struct.unpack_from(byteorder + "I" * count, self._mm, offset))
+        sizes = array("I", struct.unpack_from(byteorder + "I" * count, self._mm, offset + 4 * count))
+        return starts, sizes, offset + 8 * count
+
+    def __len__(self):
+        return self._dna_size
+
+    def __str__(self):
+        return self.get_slice(0, self._dna_size)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            key = key + self._dna_size if key < 0 else key
+            return self.get_slice(key, key + 1)
+        if key.step is not None:
+            raise ValueError("Slicing by step is not supported")
+        start, end, _ = key.indices(self._dna_size)
+        return self.get_slice(start, end)
+
+    def get_slice(self, start, end):
+        """Decode [start, end)."""
+        end = min(end, self._dna_size)
+        if end <= start:
+            return ""
+        first_byte = self._dna_offset + start // 4
+        last_byte = self._dna_offset + (end + 3) // 4
+        bases = "".join(map(BYTE_TO_BASES.__getitem__, self._mm[first_byte: last_byte]))
+        seq = bases[start % 4: start % 4 + end - start]
+        seq = apply_blocks(seq, start, self._n_starts, self._n_sizes, lambda x: "N" * len(x))
+        return apply_blocks(seq, start, self._mask_starts, self._mask_sizes, str.lower)
+
+
+class TwoBitFile:
+    """Memory-mapped 2bit file: name: TwoBitSequence, sequence headers are read on demand."""
+
+    def __init__(self, path):
+        """Map the file and read the index."""
+        self.path = path
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._sequences = {}
+        signature, version, seq_count, _ = struct.unpack_from("<IIII", self._mm, 0)
+        self._byteorder = "<"
+        if signature != SIGNATURE:  # written on a machine with another byte order
+            self._byteorder = ">"
+            signature, version, seq_count, _ = struct.unpack_from(">IIII", self._mm, 0)
+        if signature != SIGNATURE:
+            raise TwoBitError("{0} is not a 2bit file".format(path))
+        offset_format = self._byteorder + ("Q" if version == 1 else "I")  # version 1: 64-bit offsets
+        self._offsets, pos = {}, 16
+        for _ in range(seq_count):
+            name_size = self._mm[pos]
+            name = self._mm[pos + 1: pos + 1 + name_size].decode("utf-8")
+            pos += 1 + name_size
+            self._offsets[name] = struct.unpack_from(offset_format, self._mm, pos)[0]
+            pos += struct.calcsize(offset_format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __reduce__(self):  # for process pools: reopen by path
+        return (self.__class__, (self.path,))
+
+    def __contains__(self, name):
+        return name in self._offsets
+
+    def __getitem__(self, name):
+        if name not in self._sequences:
+            if name not in self._offsets:
+                raise KeyError(name)
+            self._sequences[name] = TwoBitSequence(self._mm, self._offsets[name], self._byteorder)
+        return self._sequences[name]
+
+    def keys(self):
+        """Return sequence names."""
+        return self._offsets.keys()
+
+    def sequence_sizes(self):
+        """Return name: length dict."""
+        return {name: len(self[name]) for name in self._offsets}
+
+    def close(self):
+        """Unmap and close the file."""
+        self._sequences = {}
+        self._mm.close()
+        self._f.close()
+
+
+if __name__ == "__main__":
+    # twoBitToFa-like usage: twobit_io.py file.2bit chrom [start end]
+    if len(sys.argv) < 3:
+        sys.exit("Usage: {0} [2bit file] [chrom] [start end]".format(sys.argv[0]))
+    two_bit = TwoBitFile(sys.argv[1])
+    chrom_seq = two_bit[sys.argv[2]]
+    start, end = (int(sys.argv[3]), int(sys.argv[4])) if len(sys.argv) > 4 else (0, len(chrom_seq))
+    sys.stdout.write(">{0}\n{1}\n".format(sys.argv[2], chrom_seq[start: end]))